@@ -1,13 +1,22 @@
+import asyncio
 import io
+import logging
 import re
 
-from docx import Document
-from docx.shared import Inches
+import metrics
+
+import progress
+
+import tracing
 
 try:
     from image_scrapper import downloader
+    from output import save_to_spooled_file
 except ImportError:
     from .image_scrapper import downloader
+    from .output import save_to_spooled_file
+
+logger = logging.getLogger(__name__)
 
 
 async def generate_docx_prompt(language, emotion_type, topic):
@@ -46,46 +55,168 @@ Do not include any additional information in your response and stick to the form
     return message
 
 
-async def generate_docx(answer):
-    doc = Document()
+async def generate_docx_outline_prompt(language, emotion_type, topic):
+    message = f"""Create an {language} language outline for a {emotion_type} research paper on the topic of {topic}.
+Language of research paper - {language}.
+Reply only with the Title, the Subtitle and 8 to 12 Headings of the sections of the research paper.
+
+Put this tag before the Title: [TITLE]
+Put this tag after the Title: [/TITLE]
+Put this tag before the Subtitle: [SUBTITLE]
+Put this tag after the Subtitle: [/SUBTITLE]
+Put this tag before the Heading: [HEADING]
+Put this tag after the Heading: [/HEADING]
+
+For example:
+[TITLE]Mental Health[/TITLE]
+[SUBTITLE]Understanding and Nurturing Your Mind: A Guide to Mental Health[/SUBTITLE]
+[HEADING]Mental Health Definition[/HEADING]
+[HEADING]Common Mental Health Disorders[/HEADING]
+
+Pay attention to the language of research paper - {language}.
+Do not include any special characters (?, !, ., :, ) in the Title.
+Do not include any additional information in your response and stick to the format."""
+
+    return message
 
-    async def split_tags(reply):
-        pattern = r'\[(.*?)\](.*?)\[/\1\]'
-        tags = re.findall(pattern, reply, re.DOTALL)
-        return tags
-
-    async def parse_response(tags_array):
-        if not tags_array:
-            raise IndexError
-        for item in tags_array:
-            match (item[0]):
-                case('TITLE'):
-                    doc.add_heading(item[1], 0)
-                case('SUBTITLE'):
-                    doc.add_heading(item[1], 1)
-                case('HEADING'):
-                    doc.add_heading(item[1], 2)
-                case('CONTENT'):
-                    doc.add_paragraph(item[1])
-                case('IMAGE'):
-                    try:
-                        image_data = await downloader.download(item[1], limit=1, adult_filter_off=True, timeout=15,
-                                                               filter="+filterui:aspect-wide+filterui:imagesize-wallpaper+filterui:photo-photo")
-                        doc.add_picture(io.BytesIO(image_data), width=Inches(6))
-                    except Exception:
-                        pass
-
-    async def find_title(tags_array):
-        for item in tags_array:
-            if item[0] == 'TITLE':
-                return item[1]
 
+async def generate_docx_section_prompt(language, emotion_type, topic, title, heading, headings):
+    message = f"""Write the section "{heading}" of an {language} language {emotion_type} research paper "{title}" on the topic of {topic}.
+Language of research paper - {language}.
+The research paper consists of the sections: {", ".join(headings)}.
+Write only about "{heading}", the other sections are written separately.
+Elaborate on the Content, provide as much information as possible.
+
+Put this tag before the Content: [CONTENT]
+Put this tag after the Content: [/CONTENT]
+Put this tag before the Image: [IMAGE]
+Put this tag after the Image: [/IMAGE]
+
+For example:
+[CONTENT]...[/CONTENT]
+[IMAGE]Person Meditating[/IMAGE]
+
+Pay attention to the language of research paper - {language}.
+The image should be described in general by a set of keywords, such as "Mount Everest Sunset" or "Niagara Falls Rainbow".
+Do not reply as if you are talking about the research paper itself. (ex. "Include pictures here about...")
+Do not include any additional information in your response and stick to the format."""
+
+    return message
+
+
+async def expand_outline(outline, language, emotion_type, topic, process_prompt, max_concurrency):
+    tags_array = await split_tags(outline)
+    title = find_title(tags_array)
+    headings = [item[1] for item in tags_array if item[0] == 'HEADING']
+    semaphore = asyncio.Semaphore(max_concurrency)
+    n_expanded = 0
+
+    async def expand_section(heading):
+        nonlocal n_expanded
+        async with semaphore:
+            prompt = await generate_docx_section_prompt(language, emotion_type, topic, title, heading, headings)
+            try:
+                return await process_prompt(prompt)
+            finally:
+                n_expanded += 1
+                progress.report(f"✍️ Writing sections {n_expanded}/{len(headings)}…")
+
+    sections = await asyncio.gather(*(expand_section(heading) for heading in headings), return_exceptions=True)
+    if sections and all(isinstance(section, Exception) for section in sections):
+        raise sections[0]
+
+    answer = "".join(f"[{tag}]{text}[/{tag}]\n" for tag, text in tags_array if tag in ('TITLE', 'SUBTITLE'))
+    n_used_tokens = 0
+    for heading, section in zip(headings, sections):
+        answer += f"[HEADING]{heading}[/HEADING]\n"
+        if isinstance(section, Exception):
+            logger.warning(f"Failed to expand section {heading}: {section}")
+            continue
+        section_answer, section_tokens = section
+        answer += f"{section_answer}\n"
+        n_used_tokens += section_tokens
+    return answer, n_used_tokens
+
+
+async def split_tags(reply):
+    pattern = r'\[(.*?)\](.*?)\[/\1\]'
+    tags = re.findall(pattern, reply, re.DOTALL)
+    return tags
+
+
+def find_title(tags_array):
+    for item in tags_array:
+        if item[0] == 'TITLE':
+            return item[1]
+
+
+async def fetch_images(tags_array, images=None, pool=None, deadline=None):
+    queries = [(i, item[1]) for i, item in enumerate(tags_array) if item[0] == 'IMAGE']
+    return await downloader.fetch_images(queries, {} if images is None else images, pool, deadline)
+
+
+def render_docx(tags_array, images):
+    from docx import Document
+    from docx.shared import Inches
+
+    if not tags_array:
+        raise IndexError
+    doc = Document()
+    for i, item in enumerate(tags_array):
+        match (item[0]):
+            case('TITLE'):
+                doc.add_heading(item[1], 0)
+            case('SUBTITLE'):
+                doc.add_heading(item[1], 1)
+            case('HEADING'):
+                doc.add_heading(item[1], 2)
+            case('CONTENT'):
+                doc.add_paragraph(item[1])
+            case('IMAGE'):
+                try:
+                    doc.add_picture(io.BytesIO(images[i]), width=Inches(6))
+                except Exception:
+                    pass
+    return doc
+
+
+def save_docx(doc, tags_array):
+    docx_file = save_to_spooled_file(doc)
+    docx_title = f"{find_title(tags_array)}.docx"
+    logger.debug(f"Saved {docx_title}")
+
+    return docx_file, docx_title
+
+
+async def tags_from_slides(slides, slide_images):
+    """Turn parsed presentation slides into abstract tags, so a deck's content can be rendered as a document too."""
+    tags_array = []
+    images = {}
+    for i, slide in enumerate(slides):
+        match slide["type"]:
+            case "[L_TS]":
+                tags_array.append(("TITLE", slide["title"]))
+                if slide["subtitle"]:
+                    tags_array.append(("SUBTITLE", slide["subtitle"]))
+            case "[L_CS]" | "[L_IS]":
+                tags_array.append(("HEADING", slide["title"]))
+                if slide["content"]:
+                    tags_array.append(("CONTENT", slide["content"]))
+                if slide_images.get(i):
+                    images[len(tags_array)] = slide_images[i]
+                    tags_array.append(("IMAGE", slide["image"]))
+    return tags_array, images
+
+
+def render_and_save(tags_array, images):
+    with tracing.span("render"), metrics.STAGE_SECONDS.time(stage="render"):
+        doc = render_docx(tags_array, images)
+    with tracing.span("save"), metrics.STAGE_SECONDS.time(stage="save"):
+        return save_docx(doc, tags_array)
+
+
+async def generate_docx(answer, images=None, pool=None, image_deadline=None):
     reply_array = await split_tags(answer)
-    await parse_response(reply_array)
-    buffer = io.BytesIO()
-    doc.save(buffer)
-    docx_bytes = buffer.getvalue()
-    docx_title = f"{await find_title(reply_array)}.docx"
-    print(f"done {docx_title}")
-
-    return docx_bytes, docx_title
+    images = await fetch_images(reply_array, images, pool, image_deadline)
+    progress.report("🎨 Rendering document…")
+    return await asyncio.to_thread(render_and_save, reply_array, images)
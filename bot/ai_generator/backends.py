@@ -0,0 +1,130 @@
+import asyncio
+import logging
+import math
+import random
+import statistics
+import time
+from collections import deque
+
+import config
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# completions a backend's latency and error rate are taken over
+WINDOW = 50
+# completions a backend needs before its p90 is trusted to decide when to hedge
+MIN_HEDGE_SAMPLES = 10
+# share of completions sent to a random backend, so a backend that has recovered gets noticed
+EXPLORE_SHARE = 0.05
+MIN_SUCCESS_RATE = 0.05
+
+
+class Backend:
+    """An OpenAI-compatible endpoint and model, with the latencies and errors of its recent completions."""
+
+    def __init__(self, name, model, api_base=None, api_key=None, max_slides=None):
+        self.name = name
+        self.model = model
+        self.api_base = api_base
+        self.api_key = api_key or config.openai_api_key
+        self.max_slides = max_slides
+
+        self.latencies = deque(maxlen=WINDOW)
+        self.errors = deque(maxlen=WINDOW)
+
+    def serves(self, size):
+        # a backend limited to small decks takes no abstracts, which have no slide count
+        return self.max_slides is None or (size is not None and size <= self.max_slides)
+
+    def error_rate(self):
+        return sum(self.errors) / len(self.errors) if self.errors else 0
+
+    def expected_latency(self):
+        """Median latency stretched by the retries its errors cause, 0 until it has been tried."""
+        if not self.errors:
+            return 0
+        if not self.latencies:
+            return math.inf
+        return statistics.median(self.latencies) / max(MIN_SUCCESS_RATE, 1 - self.error_rate())
+
+    def hedge_delay(self):
+        if len(self.latencies) < MIN_HEDGE_SAMPLES:
+            return None
+        return statistics.quantiles(self.latencies, n=10)[-1]
+
+    def record(self, started, error):
+        # failures often return at once, so only completions that went through count for the latency
+        if not error:
+            self.latencies.append(time.perf_counter() - started)
+        self.errors.append(1 if error else 0)
+        metrics.BACKEND_REQUESTS.inc(backend=self.name, result="error" if error else "ok")
+
+
+class Router:
+    """Sends each completion to the backend expected to be fastest and hedges it when it runs late."""
+
+    def __init__(self, backends, hedging):
+        self.backends = backends
+        self.hedging = hedging
+
+    def rank(self, size):
+        candidates = [backend for backend in self.backends if backend.serves(size)] or self.backends
+        candidates = sorted(candidates, key=Backend.expected_latency)
+        if len(candidates) > 1 and random.random() < EXPLORE_SHARE:
+            candidates.insert(0, candidates.pop(random.randrange(1, len(candidates))))
+        return candidates
+
+    async def run(self, request, backend, on_progress):
+        started = time.perf_counter()
+        try:
+            result = await request(backend, on_progress)
+        except (OverflowError, RuntimeError):
+            backend.record(started, error=True)
+            raise
+        # a cancelled request, a hedge loser or a cancelled job, is not recorded: its latency would be cut short
+        backend.record(started, error=False)
+        return result
+
+    async def complete(self, request, on_progress=None, size=None):
+        """Run request(backend, on_progress) on the best backend, failing over to the next one on errors."""
+        candidates = self.rank(size)
+        try:
+            return await self.hedged(request, candidates, on_progress)
+        except (OverflowError, RuntimeError) as e:
+            if len(candidates) < 2:
+                raise
+            logger.warning(f"Completion on {candidates[0].name} failed ({e}), failing over to {candidates[1].name}")
+            return await self.run(request, candidates[1], on_progress)
+
+    async def hedged(self, request, candidates, on_progress):
+        primary = candidates[0]
+        # hedging on the same backend would only double the load of a backend that is already slow
+        delay = primary.hedge_delay() if self.hedging and len(candidates) > 1 else None
+        first = asyncio.create_task(self.run(request, primary, on_progress))
+        tasks = [first]
+        try:
+            if delay is None or (await asyncio.wait({first}, timeout=delay))[0]:
+                return await first
+
+            backup = candidates[1]
+            logger.info(f"Completion on {primary.name} is slower than its p90 of {delay:.1f} s, "
+                        f"hedging on {backup.name}")
+            second = asyncio.create_task(self.run(request, backup, None))
+            tasks.append(second)
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        metrics.HEDGED_COMPLETIONS.inc(winner="hedge" if task is second else "first")
+                        return task.result()
+            return await first
+        finally:
+            # the loser is cancelled, its tokens may still be billed but are not charged to the user
+            for task in tasks:
+                task.cancel()
+
+
+router = Router([Backend(**backend) for backend in config.completion_backends], config.completion_hedging)
@@ -3,7 +3,13 @@ import logging
 import re
 import urllib.parse
 
-from aiohttp import ClientSession
+import http_pool
+
+import metrics
+
+import tracing
+
+SEARCH_URL = "https://www.bing.com/images/async"
 
 
 class Bing:
@@ -53,13 +59,20 @@ class Bing:
                 return shorthand
 
     async def save_image(self, link):
-        print(link)
+        # imported here so the renderers importing this module don't need the bot's config, e.g. in benchmark.py
+        import config
+
+        self.logger.debug(f"Saving image from {link}")
         for site in self.blocked_sites:
             if site in link:
                 raise ValueError("Blocked site found in URL: " + link)
-        async with ClientSession() as session:
-            async with session.get(link, timeout=self.timeout) as response:
+        with tracing.span("image_download", link=link), metrics.STAGE_SECONDS.time(stage="image_download"):
+            async with http_pool.get_session().get(link, timeout=self.timeout) as response:
+                if (response.content_length or 0) > config.max_image_bytes:
+                    raise ValueError(f"Image of {response.content_length} bytes is too large: {link}")
                 image = await response.read()
+        if len(image) > config.max_image_bytes:
+            raise ValueError(f"Image of {len(image)} bytes is too large: {link}")
 
         supported_formats = ["jpeg", "png", "gif"]
         if not imghdr.what(None, image) or imghdr.what(None, image) not in supported_formats:
@@ -83,33 +96,34 @@ class Bing:
 
         except Exception as e:
             self.download_count -= 1
+            metrics.IMAGE_DOWNLOAD_FAILURES.inc()
             self.logger.error(f'[!] Issue getting: {link}\n[!] Error:: {e}')
 
     async def run(self):
-        async with ClientSession() as session:
-            while self.download_count < self.limit:
-                if self.verbose:
-                    self.logger.info(f'\n\n[!!]Indexing page: {self.page_counter + 1}\n')
-                # Parse the page source and download pics
-                request_url = 'https://www.bing.com/images/async?q=' + urllib.parse.quote_plus(self.query) \
-                              + '&first=' + str(self.page_counter) + '&count=' + str(self.limit) \
-                              + '&adlt=' + self.adult + '&qft=' + (
-                                  '' if self.filter is None else await self.get_filter(self.filter))
-                self.logger.debug(request_url)
-                async with session.get(request_url, headers=self.headers) as response:
-                    html = await response.text()
-                self.logger.debug(html)
-                if html == "":
-                    self.logger.info('[%] No more images are available')
-                    break
-                links = re.findall('murl&quot;:&quot;(.*?)&quot;', html)
-                if self.verbose:
-                    self.logger.info(f'[%] Indexed {len(links)} Images on Page {self.page_counter + 1}.')
-                    self.logger.info('\n===============================================\n')
-                for link in links:
-                    if self.download_count < self.limit and link not in self.seen:
-                        self.seen.add(link)
-                        self.image = await self.download_image(link)
-
-                self.page_counter += 1
+        session = http_pool.get_session()
+        while self.download_count < self.limit:
+            if self.verbose:
+                self.logger.info(f'\n\n[!!]Indexing page: {self.page_counter + 1}\n')
+            # Parse the page source and download pics
+            request_url = SEARCH_URL + '?q=' + urllib.parse.quote_plus(self.query) \
+                          + '&first=' + str(self.page_counter) + '&count=' + str(self.limit) \
+                          + '&adlt=' + self.adult + '&qft=' + (
+                              '' if self.filter is None else await self.get_filter(self.filter))
+            self.logger.debug(request_url)
+            async with session.get(request_url, headers=self.headers) as response:
+                html = await response.text()
+            self.logger.debug(html)
+            if html == "":
+                self.logger.info('[%] No more images are available')
+                break
+            links = re.findall('murl&quot;:&quot;(.*?)&quot;', html)
+            if self.verbose:
+                self.logger.info(f'[%] Indexed {len(links)} Images on Page {self.page_counter + 1}.')
+                self.logger.info('\n===============================================\n')
+            for link in links:
+                if self.download_count < self.limit and link not in self.seen:
+                    self.seen.add(link)
+                    self.image = await self.download_image(link)
+
+            self.page_counter += 1
         self.logger.info(f'\n\n[%] Done. Downloaded {self.download_count} images.')
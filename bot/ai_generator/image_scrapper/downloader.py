@@ -1,8 +1,22 @@
+import asyncio
+import logging
+import re
+
+import metrics
+
+import progress
+
+import tracing
+
 try:
     from bing import Bing
 except ImportError:
     from .bing import Bing
 
+logger = logging.getLogger(__name__)
+
+IMAGE_FILTER = "+filterui:aspect-wide+filterui:imagesize-wallpaper+filterui:photo-photo"
+
 
 async def download(query, limit=100, adult_filter_off=True,
                    timeout=60, filter="", block_sites=True, verbose=True):
@@ -18,9 +32,74 @@ async def download(query, limit=100, adult_filter_off=True,
                          "vseosvita.ua"]
 
     bing = Bing(query, limit, adult, timeout, filter, blocked_sites, verbose)
-    await bing.run()
+    with tracing.span("image_search", query=query), metrics.STAGE_SECONDS.time(stage="image_search"):
+        await bing.run()
     return bing.image
 
 
+async def fetch_images(queries, images, pool, deadline):
+    """Fetch the image of each (index, query) pair into images, falling back to the pool's images.
+
+    Indexes already in images, e.g. restored from a checkpoint, are not fetched again.
+    """
+    for k, (i, query) in enumerate(queries):
+        if i in images:
+            continue
+        progress.report(f"🖼 Finding images {k}/{len(queries)}…")
+        try:
+            images[i] = await asyncio.wait_for(download(query, limit=1, adult_filter_off=True, timeout=15,
+                                                        filter=IMAGE_FILTER), deadline)
+        except Exception:
+            metrics.IMAGE_RESULTS.inc(result="error")
+        else:
+            metrics.IMAGE_RESULTS.inc(result="hit" if images[i] else "miss")
+        if not images.get(i) and pool is not None:
+            image = await pool.take()
+            if image:
+                images[i] = image
+                metrics.IMAGE_RESULTS.inc(result="prefetched")
+    return images
+
+
+def topic_queries(topic, n):
+    """The topic itself, then its significant words together and one by one, for up to n searches."""
+    words = [word for word in re.findall(r"\w+", topic) if len(word) > 3]
+    queries = [topic, " ".join(words[:3]), *words]
+    return list(dict.fromkeys(query for query in queries if query))[:n]
+
+
+class ImagePool:
+    """Images searched for in the background, handed out to slots whose own search failed."""
+
+    def __init__(self, queries, deadline):
+        # images in whatever order their searches finish, then None once all of them have
+        self.images = asyncio.Queue()
+        self.exhausted = False
+        self.task = asyncio.create_task(self.fill(queries, deadline))
+
+    async def fill(self, queries, deadline):
+        async def search(query):
+            image = await asyncio.wait_for(download(query, limit=1, adult_filter_off=True, timeout=15,
+                                                    filter=IMAGE_FILTER), deadline)
+            if image:
+                self.images.put_nowait(image)
+            return bool(image)
+
+        results = await asyncio.gather(*(search(query) for query in queries), return_exceptions=True)
+        n_found = sum(result is True for result in results)
+        logger.info(f"Prefetched {n_found} images with {len(queries)} searches")
+        self.images.put_nowait(None)
+
+    async def take(self):
+        if self.exhausted:
+            return None
+        image = await self.images.get()
+        self.exhausted = image is None
+        return image
+
+    def cancel(self):
+        self.task.cancel()
+
+
 if __name__ == '__main__':
-    download('dog', limit=10, timeout=1)
+    asyncio.run(download('dog', limit=10, timeout=1))
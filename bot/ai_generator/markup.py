@@ -0,0 +1,179 @@
+import collections
+import re
+
+import metrics
+
+FIELD_TAGS = ("TITLE", "SUBTITLE", "HEADING", "CONTENT", "IMAGE")
+SLIDE_FIELDS = ("title", "subtitle", "content", "image")
+TAG = re.compile(r"\[(/?)(L_TS|L_CS|L_IS|L_THS|SLIDEBREAK|TITLE|SUBTITLE|HEADING|CONTENT|IMAGE)\]")
+
+# reply: the repaired reply, parsed: its slides or tags, missing: indices of slides or headings without content,
+# truncated: whether the reply ended inside a field, as one cut off at max_tokens does
+Report = collections.namedtuple("Report", ["reply", "parsed", "repairs", "missing", "truncated", "score"])
+
+
+def tokenize(reply):
+    """Split a reply into slide types, slide breaks and fields, closing the fields the model left open."""
+    tokens = []
+    repairs = collections.Counter()
+    field, start, last_end = None, 0, 0
+
+    def close(tag, end, repair=None):
+        tokens.append(("field", tag, reply[start:end].strip()))
+        if repair is not None:
+            repairs[repair] += 1
+
+    for match in TAG.finditer(reply):
+        closing, tag = match.groups()
+        if closing and tag not in FIELD_TAGS:
+            continue
+        if closing:
+            if field is not None:
+                close(field, match.start(), None if field == tag else "mismatched")
+            elif reply[last_end:match.start()].strip():
+                # the opening tag is missing, so the field starts after the previous tag
+                start = last_end
+                close(tag, match.start(), "opened")
+            field = None
+        else:
+            if field is not None:
+                close(field, match.start(), "closed")
+                field = None
+            if tag in FIELD_TAGS:
+                field, start = tag, match.end()
+            elif tag == "SLIDEBREAK":
+                tokens.append(("break",))
+            else:
+                tokens.append(("type", f"[{tag}]"))
+        last_end = match.end()
+    truncated = field is not None
+    if truncated:
+        close(field, len(reply), "closed")
+    return tokens, repairs, truncated
+
+
+def infer_slide_type(slide, index):
+    if slide["image"]:
+        return "[L_IS]"
+    if slide["content"]:
+        return "[L_CS]"
+    if slide["subtitle"] or index == 0:
+        return "[L_TS]"
+    return "[L_THS]"
+
+
+def missing_content(slides):
+    return [i for i, slide in enumerate(slides) if slide["type"] in ("[L_CS]", "[L_IS]") and not slide["content"]]
+
+
+def format_slides(slides):
+    reply = ""
+    for slide in slides:
+        reply += f"{slide['type']}\n"
+        for key in SLIDE_FIELDS:
+            if slide[key]:
+                reply += f"[{key.upper()}]{slide[key]}[/{key.upper()}]\n"
+        reply += "[SLIDEBREAK]\n"
+    return reply
+
+
+def format_tags(tags_array):
+    return "".join(f"[{tag}]{text}[/{tag}]\n" for tag, text in tags_array)
+
+
+def score(repairs, n_parts):
+    # 1 for a reply that needed no repair, lower the more repairs per slide or tag it needed
+    if not n_parts:
+        return 0
+    return max(0, 1 - sum(repairs.values()) / n_parts)
+
+
+def repair_presentation(reply):
+    """Parse a presentation reply into slides the way parse_slides does, repairing the markup on the way.
+
+    Open tags are closed, slides run into each other without [SLIDEBREAK] are split, slides without a type
+    get one from their fields and image slides without image keywords search for their title.
+    """
+    tokens, repairs, truncated = tokenize(reply)
+    slides = [dict.fromkeys(["type", *SLIDE_FIELDS], "")]
+    for token in tokens:
+        slide = slides[-1]
+        if token[0] == "break":
+            slides.append(dict.fromkeys(["type", *SLIDE_FIELDS], ""))
+            continue
+        if token[0] == "type":
+            if slide["type"] or any(slide[key] for key in SLIDE_FIELDS):
+                repairs["split"] += 1
+                slide = dict.fromkeys(["type", *SLIDE_FIELDS], "")
+                slides.append(slide)
+            slide["type"] = token[1]
+            continue
+        _, tag, text = token
+        if tag == "HEADING":
+            repairs["renamed"] += 1
+            tag = "TITLE"
+        key = tag.lower()
+        if key == "title" and slide["title"]:
+            repairs["split"] += 1
+            slide = dict.fromkeys(["type", *SLIDE_FIELDS], "")
+            slides.append(slide)
+        if slide[key] and text:
+            repairs["merged"] += 1
+            if key == "content":
+                slide[key] += "\n" + text
+        elif text:
+            slide[key] = text
+
+    slides = [slide for slide in slides if any(slide[key] for key in SLIDE_FIELDS)]
+    for i, slide in enumerate(slides):
+        if not slide["type"]:
+            repairs["typed"] += 1
+            slide["type"] = infer_slide_type(slide, i)
+        if slide["type"] == "[L_IS]" and not slide["image"]:
+            repairs["image"] += 1
+            slide["image"] = slide["title"]
+    for repair, n in repairs.items():
+        metrics.MARKUP_REPAIRS.inc(n, kind="presentation", repair=repair)
+    reply_score = score(repairs, len(slides))
+    metrics.MARKUP_SCORE.observe(reply_score, kind="presentation")
+    return Report(format_slides(slides), slides, repairs, missing_content(slides), truncated,
+                  reply_score)
+
+
+def repair_abstract(reply):
+    """Parse an abstract reply into tags the way split_tags does, repairing the markup on the way.
+
+    Open tags are closed, empty tags are dropped and an abstract without a title gets its first heading as one.
+    """
+    tokens, repairs, truncated = tokenize(reply)
+    tags_array = []
+    for token in tokens:
+        if token[0] != "field":
+            continue
+        if not token[2]:
+            repairs["empty"] += 1
+            continue
+        tags_array.append(token[1:])
+
+    if tags_array and all(tag != "TITLE" for tag, _ in tags_array):
+        heading = next((i for i, (tag, _) in enumerate(tags_array) if tag == "HEADING"), None)
+        if heading is not None:
+            repairs["title"] += 1
+            tags_array[heading] = ("TITLE", tags_array[heading][1])
+
+    missing = []
+    for i, (tag, _) in enumerate(tags_array):
+        if tag == "HEADING":
+            section = []
+            for next_tag, _ in tags_array[i + 1:]:
+                if next_tag in ("TITLE", "HEADING"):
+                    break
+                section.append(next_tag)
+            if "CONTENT" not in section:
+                missing.append(i)
+    for repair, n in repairs.items():
+        metrics.MARKUP_REPAIRS.inc(n, kind="abstract", repair=repair)
+    reply_score = score(repairs, len(tags_array))
+    metrics.MARKUP_SCORE.observe(reply_score, kind="abstract")
+    return Report(format_tags(tags_array), tags_array, repairs, missing, truncated,
+                  reply_score)
@@ -1,8 +1,18 @@
+import contextlib
+import functools
+
 import config
 
-import openai
+import http_pool
+
+import metrics
+
+import tracing
 
-openai.api_key = config.openai_api_key
+try:
+    import backends
+except ImportError:
+    from . import backends
 
 OPENAI_COMPLETION_OPTIONS = {
     "temperature": 0.75,
@@ -13,23 +23,104 @@ OPENAI_COMPLETION_OPTIONS = {
 }
 
 
-async def process_prompt(message):
-    answer = None
-    while answer is None:
-        try:
+def load_openai():
+    # imported on first use (or during warm-up) to keep the bot's start-up light
+    import openai
+
+    openai.api_key = config.openai_api_key
+    openai.aiosession.set(http_pool.get_session())
+    return openai
+
+
+@functools.lru_cache
+def get_encoding(model):
+    # imported on first use like openai, only streamed completions are tokenized here
+    import tiktoken
+
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        # models served by other backends under their own names
+        return tiktoken.get_encoding("cl100k_base")
+
+
+def count_prompt_tokens(model, messages):
+    # every message is wrapped in 4 tokens of chat markup and the reply is primed with 3 more
+    encoding = get_encoding(model)
+    return sum(4 + len(encoding.encode(message["content"])) for message in messages) + 3
+
+
+def count_completion_tokens(model, answer):
+    return len(get_encoding(model).encode(answer))
+
+
+def build_messages(message, system=None):
+    messages = [{"role": "user", "content": message}]
+    if system:
+        messages.insert(0, {"role": "system", "content": system})
+    return messages
+
+
+async def stream_completion(backend, messages, on_progress):
+    openai = load_openai()
+    answer = ""
+    response = await openai.ChatCompletion.acreate(
+        model=backend.model,
+        messages=messages,
+        stream=True,
+        api_key=backend.api_key,
+        api_base=backend.api_base,
+        **OPENAI_COMPLETION_OPTIONS
+    )
+    async for chunk in response:
+        delta = chunk['choices'][0]['delta'].get('content')
+        if delta:
+            answer += delta
+            if on_progress is not None:
+                on_progress(answer)
+    # streamed responses carry no usage, so it is counted with the model's tokenizer
+    return answer, count_prompt_tokens(backend.model, messages), count_completion_tokens(backend.model, answer)
+
+
+async def request_completion(backend, on_progress, messages, stream):
+    openai = load_openai()
+    try:
+        with tracing.span("llm_request", backend=backend.name), \
+                metrics.BACKEND_SECONDS.time(backend=backend.name):
+            if stream:
+                return await stream_completion(backend, messages, on_progress)
             response = await openai.ChatCompletion.acreate(
-                model="gpt-3.5-turbo",
-                messages=[
-                    {"role": "user", "content": message}
-                ],
+                model=backend.model,
+                messages=messages,
+                api_key=backend.api_key,
+                api_base=backend.api_base,
                 **OPENAI_COMPLETION_OPTIONS
             )
-            answer = response['choices'][0]['message']['content']
-            n_used_tokens = response.usage.total_tokens
-        except openai.error.InvalidRequestError as e:  # too many tokens
-            raise ValueError("Too many tokens to make completion") from e
-        except openai.error.RateLimitError as e:
-            raise OverflowError("That model is currently overloaded with other requests.") from e
-        except openai.error.APIError as e:
-            raise RuntimeError("HTTP code 502 from API") from e
-    return answer, n_used_tokens
+            return (response['choices'][0]['message']['content'], response.usage.prompt_tokens,
+                    response.usage.completion_tokens)
+    except openai.error.InvalidRequestError as e:  # too many tokens
+        metrics.ERRORS.inc(type=type(e).__name__)
+        raise ValueError("Too many tokens to make completion") from e
+    except openai.error.RateLimitError as e:
+        metrics.ERRORS.inc(type=type(e).__name__)
+        raise OverflowError("That model is currently overloaded with other requests.") from e
+    except (openai.error.APIError, openai.error.APIConnectionError, openai.error.Timeout,
+            openai.error.ServiceUnavailableError) as e:
+        metrics.ERRORS.inc(type=type(e).__name__)
+        raise RuntimeError(f"{type(e).__name__} from {backend.name}") from e
+
+
+async def process_prompt(message, on_progress=None, system=None, variant=None, size=None):
+    """Complete the prompt on the completion backend routing picks for a job of size slides."""
+    request = functools.partial(request_completion, messages=build_messages(message, system),
+                                stream=on_progress is not None and config.stream_completions)
+    variant_timer = metrics.PROMPT_SECONDS.time(variant=variant) if variant else contextlib.nullcontext()
+    with tracing.span("llm_completion", variant=variant), \
+            metrics.STAGE_SECONDS.time(stage="llm_completion"), variant_timer:
+        answer, n_prompt_tokens, n_completion_tokens = await backends.router.complete(request, on_progress, size)
+    metrics.TOKENS.inc(n_prompt_tokens, kind="prompt")
+    metrics.TOKENS.inc(n_completion_tokens, kind="completion")
+    if variant is not None:
+        metrics.PROMPT_TOKENS.inc(n_prompt_tokens, variant=variant, kind="prompt")
+        metrics.PROMPT_TOKENS.inc(n_completion_tokens, variant=variant, kind="completion")
+    return answer, n_prompt_tokens + n_completion_tokens
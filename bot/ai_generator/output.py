@@ -0,0 +1,35 @@
+import hashlib
+import tempfile
+import zipfile
+
+# generated documents bigger than this are spooled to disk instead of being kept in memory
+SPOOL_MAX_SIZE = 1024 * 1024
+
+
+class SpooledDocumentFile(tempfile.SpooledTemporaryFile):
+    @property
+    def name(self):
+        # python-telegram-bot takes the name of a file it uploads as a path, which is None while it is in memory
+        name = super().name
+        return "" if name is None else name
+
+
+def save_to_spooled_file(document):
+    file = SpooledDocumentFile(max_size=SPOOL_MAX_SIZE)
+    document.save(file)
+    file.seek(0)
+    return file
+
+
+def document_key(file, filename):
+    """Hash a saved pptx/docx by the bytes of its zip members, leaving out the zip timestamps that differ between saves."""
+    file.seek(0)
+    digest = hashlib.sha256(filename.encode())
+    with zipfile.ZipFile(file) as archive:
+        for info in sorted(archive.infolist(), key=lambda info: info.filename):
+            digest.update(f"\0{info.filename}\0{info.file_size}\0".encode())
+            with archive.open(info) as member:
+                for chunk in iter(lambda: member.read(64 * 1024), b""):
+                    digest.update(chunk)
+    file.seek(0)
+    return digest.hexdigest()
@@ -1,13 +1,76 @@
+import asyncio
 import io
+import logging
 import os
 import re
 
-from pptx import Presentation
+import metrics
+
+import progress
+
+import tracing
 
 try:
     from image_scrapper import downloader
+    from output import save_to_spooled_file
 except ImportError:
     from .image_scrapper import downloader
+    from .output import save_to_spooled_file
+
+logger = logging.getLogger(__name__)
+
+TEMPLATES_DIR = os.path.join(os.path.dirname(__file__), "presentation_templates")
+
+# template name -> contents of its .pptx, filled by preload_templates()
+template_cache = {}
+
+
+def preload_templates():
+    from pptx import Presentation
+
+    for name in os.listdir(TEMPLATES_DIR):
+        if name.endswith(".pptx"):
+            with open(os.path.join(TEMPLATES_DIR, name), "rb") as f:
+                template_cache[name[:-len(".pptx")]] = f.read()
+    # parsing every template once also warms up the lazily built parts of python-pptx and lxml
+    for template in template_cache.values():
+        Presentation(io.BytesIO(template))
+
+
+def open_template(template):
+    from pptx import Presentation
+
+    if template in template_cache:
+        return Presentation(io.BytesIO(template_cache[template]))
+    return Presentation(os.path.join(TEMPLATES_DIR, f"{template}.pptx"))
+
+
+def template_size(template):
+    if template in template_cache:
+        return len(template_cache[template])
+    return os.path.getsize(os.path.join(TEMPLATES_DIR, f"{template}.pptx"))
+
+
+# the tags and rules of the legacy format, shared by the prompts of a whole presentation, a slide and a continuation
+FIELD_TAGS = """Put this tag before the Title: [TITLE]
+Put this tag after the Title: [/TITLE]
+Put this tag before the Subtitle: [SUBTITLE]
+Put this tag after the Subtitle: [/SUBTITLE]
+Put this tag before the Content: [CONTENT]
+Put this tag after the Content: [/CONTENT]
+Put this tag before the Image: [IMAGE]
+Put this tag after the Image: [/IMAGE]"""
+
+
+def format_rules(language, image):
+    return f"""Elaborate on the Content, provide as much information as possible.
+You put a [/CONTENT] at the end of the Content.
+Pay attention to the language of presentation - {language}.
+{image} should be described in general by a set of keywords, such as "Mount Everest Sunset" or "Niagara Falls Rainbow".
+Do not write Image in Content tag.
+Do not reply as if you are talking about the slideshow itself. (ex. "Include pictures here about...")
+Do not include any special characters (?, !, ., :, ) in the Title.
+Do not include any additional information in your response and stick to the format."""
 
 
 async def generate_ppt_prompt(language, emotion_type, slide_length, topic):
@@ -44,30 +107,117 @@ For example:
 
 [SLIDEBREAK]
 
-Put this tag before the Title: [TITLE]
-Put this tag after the Title: [/TITLE]
-Put this tag before the Subtitle: [SUBTITLE]
-Put this tag after the Subtitle: [/SUBTITLE]
-Put this tag before the Content: [CONTENT]
-Put this tag after the Content: [/CONTENT]
-Put this tag before the Image: [IMAGE]
-Put this tag after the Image: [/IMAGE]
+{FIELD_TAGS}
 
-Elaborate on the Content, provide as much information as possible.
-You put a [/CONTENT] at the end of the Content.
-Pay attention to the language of presentation - {language}.
-Each image should be described in general by a set of keywords, such as "Mount Everest Sunset" or "Niagara Falls Rainbow".
-Do not write Image in Content tag.
-Do not reply as if you are talking about the slideshow itself. (ex. "Include pictures here about...")
-Do not include any special characters (?, !, ., :, ) in the Title.
-Do not include any additional information in your response and stick to the format."""
+{format_rules(language, "Each image")}"""
+
+    return message
+
+
+SLIDE_TYPES = {
+    "[L_TS]": "Title Slide - (Title, Subtitle)",
+    "[L_CS]": "Content Slide - (Title, Content)",
+    "[L_IS]": "Image Slide - (Title, Content, Image)",
+    "[L_THS]": "Thanks Slide - (Title)",
+}
+
+
+async def generate_slide_prompt(language, emotion_type, topic, slides, index):
+    slide = slides[index]
+    titles = "\n".join(f"{i + 1}. {other['title']}" for i, other in enumerate(slides))
+    message = f"""Rewrite slide {index + 1} "{slide['title']}" of an {language} language outline for a {emotion_type} slideshow presentation on the topic of {topic}.
+The slides of the presentation are:
+{titles}
+
+Write only slide {index + 1}, the other slides stay as they are.
+The slide is a {SLIDE_TYPES[slide["type"]]}.
+Put this tag before the slide: {slide["type"]}
+
+{FIELD_TAGS}
+
+{format_rules(language, "The image")}"""
+
+    return message
+
+
+async def generate_continuation_prompt(language, emotion_type, topic, slides, slide_length):
+    titles = "\n".join(f"{i + 1}. {slide['title']}" for i, slide in enumerate(slides))
+    slide_types = "\n".join(f"{tag} {description}" for tag, description in SLIDE_TYPES.items())
+    message = f"""Continue an {language} language outline for a {emotion_type} slideshow presentation on the topic of {topic} which is {slide_length} slides long.
+The first {len(slides)} slides are already written:
+{titles}
+
+Write only slides {len(slides) + 1} to {slide_length}.
+
+Put the tag of its type before each Slide:
+{slide_types}
+
+Put this tag after each Slide: [SLIDEBREAK]
+
+{FIELD_TAGS}
+
+{format_rules(language, "Each image")}"""
 
     return message
 
 
-async def generate_ppt(answer, template):
-    template = os.path.join("bot", "ai_generator", "presentation_templates", f"{template}.pptx")
-    root = Presentation(template)
+async def find_text_in_between_tags(text, start_tag, end_tag):
+    start_pos = text.find(start_tag)
+    end_pos = text.find(end_tag)
+    result = []
+    while start_pos > -1 and end_pos > -1:
+        text_between_tags = text[start_pos + len(start_tag):end_pos]
+        result.append(text_between_tags)
+        start_pos = text.find(start_tag, end_pos + len(end_tag))
+        end_pos = text.find(end_tag, start_pos)
+    res1 = "".join(result)
+    res2 = re.sub(r"\[IMAGE\].*?\[/IMAGE\]", '', res1)
+    if len(result) > 0:
+        return res2
+    else:
+        return ""
+
+
+async def search_for_slide_type(text):
+    tags = ["[L_TS]", "[L_CS]", "[L_IS]", "[L_THS]"]
+    found_text = next((s for s in tags if s in text), None)
+    return found_text
+
+
+async def parse_slides(reply):
+    slides = []
+    for slide in reply.split("[SLIDEBREAK]"):
+        slide_type = await search_for_slide_type(slide)
+        if slide_type is None:
+            continue
+        slides.append({
+            "type": slide_type,
+            "title": await find_text_in_between_tags(slide, "[TITLE]", "[/TITLE]"),
+            "subtitle": await find_text_in_between_tags(slide, "[SUBTITLE]", "[/SUBTITLE]"),
+            "content": await find_text_in_between_tags(slide, "[CONTENT]", "[/CONTENT]"),
+            "image": await find_text_in_between_tags(slide, "[IMAGE]", "[/IMAGE]"),
+        })
+    return slides
+
+
+async def replace_slide(reply, index, slide_reply):
+    """Put the slide of slide_reply in place of the index-th slide of reply, keeping the other slides' text."""
+    slides = [slide for slide in reply.split("[SLIDEBREAK]") if await search_for_slide_type(slide) is not None]
+    if await search_for_slide_type(slide_reply) is None:
+        slide_reply = await search_for_slide_type(slides[index]) + "\n" + slide_reply
+    new_slides = [slide for slide in slide_reply.split("[SLIDEBREAK]") if await search_for_slide_type(slide) is not None]
+    slides[index] = new_slides[0]
+    return "\n[SLIDEBREAK]\n".join(slides)
+
+
+async def fetch_images(slides, images=None, pool=None, deadline=None):
+    queries = [(i, slide["image"]) for i, slide in enumerate(slides) if slide["type"] == "[L_IS]"]
+    return await downloader.fetch_images(queries, {} if images is None else images, pool, deadline)
+
+
+def render_ppt(slides, images, template):
+    root = open_template(template)
+    template_parts = list(root.part.package.iter_parts())
 
     # """ Ref for slide types:
     # 0 -> title and subtitle
@@ -81,90 +231,85 @@ async def generate_ppt(answer, template):
     # 8 -> Pic with caption
     # """
 
-    async def delete_all_slides():
+    def delete_all_slides():
         for i in range(len(root.slides) - 1, -1, -1):
             r_id = root.slides._sldIdLst[i].rId
             root.part.drop_rel(r_id)
             del root.slides._sldIdLst[i]
 
-    async def create_title_slide(title, subtitle):
+    def create_title_slide(title, subtitle):
         layout = root.slide_layouts[0]
         slide = root.slides.add_slide(layout)
         slide.shapes.title.text = title
         slide.placeholders[1].text = subtitle
 
-    async def create_section_header_slide(title):
+    def create_section_header_slide(title):
         layout = root.slide_layouts[2]
         slide = root.slides.add_slide(layout)
         slide.shapes.title.text = title
 
-    async def create_title_and_content_slide(title, content):
+    def create_title_and_content_slide(title, content):
         layout = root.slide_layouts[1]
         slide = root.slides.add_slide(layout)
         slide.shapes.title.text = title
         slide.placeholders[1].text = content
 
-    async def create_title_and_content_and_image_slide(title, content, image_query):
+    def create_title_and_content_and_image_slide(title, content, image_data):
         layout = root.slide_layouts[8]
         slide = root.slides.add_slide(layout)
         slide.shapes.title.text = title
         slide.placeholders[2].text = content
 
         try:
-            image_data = await downloader.download(image_query, limit=1, adult_filter_off=True, timeout=15,
-                                                   filter="+filterui:aspect-wide+filterui:imagesize-wallpaper+filterui:photo-photo")
             slide.placeholders[1].insert_picture(io.BytesIO(image_data))
         except Exception:
             pass
 
-    async def find_text_in_between_tags(text, start_tag, end_tag):
-        start_pos = text.find(start_tag)
-        end_pos = text.find(end_tag)
-        result = []
-        while start_pos > -1 and end_pos > -1:
-            text_between_tags = text[start_pos + len(start_tag):end_pos]
-            result.append(text_between_tags)
-            start_pos = text.find(start_tag, end_pos + len(end_tag))
-            end_pos = text.find(end_tag, start_pos)
-        res1 = "".join(result)
-        res2 = re.sub(r"\[IMAGE\].*?\[/IMAGE\]", '', res1)
-        if len(result) > 0:
-            return res2
-        else:
-            return ""
-
-    async def search_for_slide_type(text):
-        tags = ["[L_TS]", "[L_CS]", "[L_IS]", "[L_THS]"]
-        found_text = next((s for s in tags if s in text), None)
-        return found_text
-
-    async def parse_response(reply):
-        list_of_slides = reply.split("[SLIDEBREAK]")
-        for slide in list_of_slides:
-            slide_type = await search_for_slide_type(slide)
-            match slide_type:
+    def prune_orphaned_parts():
+        # layouts that no generated slide is based on still pull their media into the package
+        used_layouts = {slide.slide_layout.part.partname for slide in root.slides}
+        for master in root.slide_masters:
+            for layout in list(master.slide_layouts):
+                if layout.part.partname not in used_layouts:
+                    master.slide_layouts.remove(layout)
+        reachable_parts = set(root.part.package.iter_parts())
+        return sum(len(part.blob) for part in template_parts if part not in reachable_parts)
+
+    delete_all_slides()
+    for i, slide in enumerate(slides):
+        with tracing.span("create_slide", index=i, type=slide["type"]):
+            match slide["type"]:
                 case ("[L_TS]"):
-                    await create_title_slide(await find_text_in_between_tags(str(slide), "[TITLE]", "[/TITLE]"),
-                                             await find_text_in_between_tags(str(slide), "[SUBTITLE]", "[/SUBTITLE]"))
+                    create_title_slide(slide["title"], slide["subtitle"])
                 case ("[L_CS]"):
-                    await create_title_and_content_slide("".join(await find_text_in_between_tags(str(slide), "[TITLE]", "[/TITLE]")),
-                                                         "".join(await find_text_in_between_tags(str(slide), "[CONTENT]", "[/CONTENT]")))
+                    create_title_and_content_slide(slide["title"], slide["content"])
                 case ("[L_IS]"):
-                    await create_title_and_content_and_image_slide("".join(await find_text_in_between_tags(str(slide), "[TITLE]", "[/TITLE]")),
-                                                                   "".join(await find_text_in_between_tags(str(slide), "[CONTENT]", "[/CONTENT]")),
-                                                                   "".join(await find_text_in_between_tags(str(slide), "[IMAGE]", "[/IMAGE]")))
+                    create_title_and_content_and_image_slide(slide["title"], slide["content"], images.get(i))
                 case ("[L_THS]"):
-                    await create_section_header_slide("".join(await find_text_in_between_tags(str(slide), "[TITLE]", "[/TITLE]")))
+                    create_section_header_slide(slide["title"])
+    pruned_bytes = prune_orphaned_parts()
+    logger.info(f"Pruned {pruned_bytes} uncompressed bytes of unused parts from {template} template")
+
+    return root
+
+
+def save_ppt(root):
+    pptx_file = save_to_spooled_file(root)
+    pptx_title = f"{root.slides[0].shapes.title.text}.pptx"
+    logger.debug(f"Saved {pptx_title}")
+
+    return pptx_file, pptx_title
+
 
-    async def find_title():
-        return root.slides[0].shapes.title.text
+def render_and_save(slides, images, template):
+    with tracing.span("render", template=template), metrics.STAGE_SECONDS.time(stage="render"):
+        root = render_ppt(slides, images, template)
+    with tracing.span("save"), metrics.STAGE_SECONDS.time(stage="save"):
+        return save_ppt(root)
 
-    await delete_all_slides()
-    await parse_response(answer)
-    buffer = io.BytesIO()
-    root.save(buffer)
-    pptx_bytes = buffer.getvalue()
-    pptx_title = f"{await find_title()}.pptx"
-    print(f"done {pptx_title}")
 
-    return pptx_bytes, pptx_title
+async def generate_ppt(answer, template, images=None, pool=None, image_deadline=None):
+    slides = await parse_slides(answer)
+    images = await fetch_images(slides, images, pool, image_deadline)
+    progress.report("🎨 Rendering slides…")
+    return await asyncio.to_thread(render_and_save, slides, images, template)
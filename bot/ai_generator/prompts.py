@@ -0,0 +1,104 @@
+import random
+from collections import namedtuple
+
+import config
+
+import metrics
+
+try:
+    import abstract
+    import presentation
+except ImportError:
+    from . import abstract
+    from . import presentation
+
+# the original prompts, every instruction repeated in the user message
+LEGACY = "v1"
+
+PRESENTATION_SYSTEM_V2 = """You write slideshow outlines in a tagged format.
+Slide types: [L_TS] title slide (Title, Subtitle), [L_CS] content slide (Title, Content), [L_IS] image slide (Title, Content, Image), [L_THS] thanks slide (Title).
+Start every slide with its type tag and end it with [SLIDEBREAK]. Wrap the fields in [TITLE][/TITLE], [SUBTITLE][/SUBTITLE], [CONTENT][/CONTENT] and [IMAGE][/IMAGE].
+Example:
+[L_TS]
+[TITLE]Mount Everest The Highest Peak in the World[/TITLE]
+[SUBTITLE]Facts and history[/SUBTITLE]
+[SLIDEBREAK]
+[L_IS]
+[TITLE]Facts about Mount Everest[/TITLE]
+[CONTENT]• It is 8,848 meters high
+• First climbed on May 29, 1953[/CONTENT]
+[IMAGE]Mount Everest[/IMAGE]
+[SLIDEBREAK]
+Elaborate on the Content. An Image is a few search keywords such as "Niagara Falls Rainbow", never put it in the Content.
+No special characters (?, !, ., :) in Titles. Reply with the slides only, in the requested language."""
+
+ABSTRACT_SYSTEM_V2 = """You write research paper outlines in a tagged format.
+Wrap the parts in [TITLE][/TITLE], [SUBTITLE][/SUBTITLE], [HEADING][/HEADING], [CONTENT][/CONTENT] and [IMAGE][/IMAGE]. Close every tag before opening the next one.
+Example:
+[TITLE]Mental Health[/TITLE]
+[SUBTITLE]Understanding and Nurturing Your Mind[/SUBTITLE]
+[HEADING]Mental Health Definition[/HEADING]
+[CONTENT]...[/CONTENT]
+[IMAGE]Person Meditating[/IMAGE]
+Write as many sections as possible and elaborate on every Content. An Image is a few search keywords such as "Mount Everest Sunset".
+No special characters (?, !, ., :) in the Title. Reply with the outline only, in the requested language."""
+
+
+Prompt = namedtuple("Prompt", ["variant", "system", "user"])
+
+
+async def presentation_v1(language, emotion_type, slide_length, topic):
+    return None, await presentation.generate_ppt_prompt(language, emotion_type, slide_length, topic)
+
+
+async def presentation_v2(language, emotion_type, slide_length, topic):
+    return PRESENTATION_SYSTEM_V2, f"Language: {language}\nStyle: {emotion_type}\nSlides: {slide_length}\nTopic: {topic}"
+
+
+async def abstract_v1(language, emotion_type, topic):
+    return None, await abstract.generate_docx_prompt(language, emotion_type, topic)
+
+
+async def abstract_v2(language, emotion_type, topic):
+    return ABSTRACT_SYSTEM_V2, f"Language: {language}\nStyle: {emotion_type}\nTopic: {topic}"
+
+
+VARIANTS = {
+    "presentation": {"v1": presentation_v1, "v2": presentation_v2},
+    "abstract": {"v1": abstract_v1, "v2": abstract_v2},
+}
+
+
+async def presentation_parses(reply):
+    slides = await presentation.parse_slides(reply)
+    return bool(slides) and all(slide["title"] for slide in slides)
+
+
+async def abstract_parses(reply):
+    tags = [tag for tag, _ in await abstract.split_tags(reply)]
+    return "TITLE" in tags and "CONTENT" in tags
+
+
+PARSERS = {
+    "presentation": presentation_parses,
+    "abstract": abstract_parses,
+}
+
+
+def choose_variant(kind):
+    # prompt_variants weighs the variants of a kind against each other, e.g. {v1: 1, v2: 1} for an even split
+    weights = config.prompt_variants.get(kind) or {LEGACY: 1}
+    return random.choices(list(weights), weights=list(weights.values()))[0]
+
+
+async def build(kind, variant=None, **params):
+    variant = variant or choose_variant(kind)
+    system, user = await VARIANTS[kind][variant](**params)
+    return Prompt(f"{kind}/{variant}", system, user)
+
+
+async def check_reply(variant, reply):
+    """Record whether a completion of the variant parses and return whether it does."""
+    parses = await PARSERS[variant.split("/")[0]](reply)
+    metrics.PROMPT_PARSES.inc(variant=variant, result="ok" if parses else "failed")
+    return parses
@@ -0,0 +1,157 @@
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+
+import ai_generator.abstract as abstract
+import ai_generator.presentation as presentation
+
+
+FIXTURES_DIR = Path(__file__).parent.resolve() / "benchmark_fixtures"
+COUNTS = list(range(3, 27))
+CONTENT = ("• It is 8,848 meters (29,029 ft) high above sea level\n"
+           "• First successfully climbed by Sir Edmund Hillary and Tenzing Norgay on May 29, 1953\n"
+           "• Over 300 climbers have died attempting to scale the mountain")
+
+
+def list_templates():
+    return sorted(name[:-len(".pptx")] for name in os.listdir(presentation.TEMPLATES_DIR) if name.endswith(".pptx"))
+
+
+def load_fixture_images():
+    return [path.read_bytes() for path in sorted(FIXTURES_DIR.iterdir()) if path.suffix in (".jpg", ".png")]
+
+
+def synthetic_presentation_reply(slide_count):
+    slides = ["[L_TS]\n[TITLE]Mount Everest The Highest Peak in the World[/TITLE]\n"
+              "[SUBTITLE]A benchmark presentation[/SUBTITLE]"]
+    for i in range(1, slide_count - 1):
+        if i % 2:
+            slides.append(f"[L_IS]\n[TITLE]Facts about Mount Everest {i}[/TITLE]\n"
+                          f"[CONTENT]{CONTENT}[/CONTENT]\n[IMAGE]Mount Everest Sunset {i}[/IMAGE]")
+        else:
+            slides.append(f"[L_CS]\n[TITLE]History of Mount Everest {i}[/TITLE]\n[CONTENT]{CONTENT}[/CONTENT]")
+    slides.append("[L_THS]\n[TITLE]Thank you[/TITLE]")
+    return "\n\n[SLIDEBREAK]\n\n".join(slides)
+
+
+def synthetic_abstract_reply(section_count):
+    reply = ("[TITLE]Mount Everest[/TITLE]\n"
+             "[SUBTITLE]Understanding the Highest Peak in the World[/SUBTITLE]\n")
+    for i in range(section_count):
+        reply += (f"[HEADING]Section {i + 1}[/HEADING]\n"
+                  f"[CONTENT]{CONTENT * 4}[/CONTENT]\n"
+                  f"[IMAGE]Mount Everest Sunset {i}[/IMAGE]\n")
+    return reply
+
+
+def fixture_images_for(keys, fixture_images):
+    return {key: fixture_images[i % len(fixture_images)] for i, key in enumerate(keys)}
+
+
+async def run_presentation(template, slide_count, fixture_images):
+    reply = synthetic_presentation_reply(slide_count)
+    timings = {}
+
+    started = time.perf_counter()
+    slides = await presentation.parse_slides(reply)
+    timings["parse_s"] = time.perf_counter() - started
+
+    images = fixture_images_for([i for i, slide in enumerate(slides) if slide["type"] == "[L_IS]"], fixture_images)
+
+    started = time.perf_counter()
+    root = presentation.render_ppt(slides, images, template)
+    timings["render_s"] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    pptx_file, _ = presentation.save_ppt(root)
+    timings["save_s"] = time.perf_counter() - started
+
+    with pptx_file:
+        timings["output_bytes"] = pptx_file.seek(0, os.SEEK_END)
+    return timings
+
+
+async def run_abstract(section_count, fixture_images):
+    reply = synthetic_abstract_reply(section_count)
+    timings = {}
+
+    started = time.perf_counter()
+    tags = await abstract.split_tags(reply)
+    timings["parse_s"] = time.perf_counter() - started
+
+    images = fixture_images_for([i for i, item in enumerate(tags) if item[0] == "IMAGE"], fixture_images)
+
+    started = time.perf_counter()
+    doc = abstract.render_docx(tags, images)
+    timings["render_s"] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    docx_file, _ = abstract.save_docx(doc, tags)
+    timings["save_s"] = time.perf_counter() - started
+
+    with docx_file:
+        timings["output_bytes"] = docx_file.seek(0, os.SEEK_END)
+    return timings
+
+
+async def measure(run, repeat):
+    # timings are taken without tracemalloc, its overhead would dominate the render numbers
+    runs = [await run() for _ in range(repeat)]
+    result = {key: statistics.median(r[key] for r in runs) for key in ("parse_s", "render_s", "save_s")}
+    result["output_bytes"] = runs[-1]["output_bytes"]
+
+    tracemalloc.start()
+    try:
+        await run()
+        result["peak_memory_bytes"] = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return result
+
+
+async def run_benchmark(templates, counts, repeat):
+    fixture_images = load_fixture_images()
+    results = []
+    for template in templates:
+        for count in counts:
+            result = await measure(lambda: run_presentation(template, count, fixture_images), repeat)
+            results.append({"kind": "pptx", "template": template, "count": count, **result})
+    for count in counts:
+        result = await measure(lambda: run_abstract(count, fixture_images), repeat)
+        results.append({"kind": "docx", "template": None, "count": count, **result})
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "repeat": repeat,
+        "results": results,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline rendering benchmark for generated presentations and abstracts")
+    parser.add_argument("--templates", nargs="+", default=list_templates())
+    parser.add_argument("--counts", nargs="+", type=int, default=COUNTS)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--output", help="path of the JSON report, printed to stdout if omitted")
+    args = parser.parse_args()
+
+    # keep the renderers' progress output away from a report written to stdout
+    with contextlib.redirect_stdout(sys.stderr):
+        report = asyncio.run(run_benchmark(args.templates, args.counts, args.repeat))
+    report_json = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        Path(args.output).write_text(report_json)
+    else:
+        sys.stdout.write(report_json + "\n")
+
+
+if __name__ == "__main__":
+    main()
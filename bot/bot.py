@@ -1,18 +1,38 @@
 import asyncio
+import functools
 import html
 import json
 import logging
+import math
 import traceback
+import uuid
 from datetime import datetime
 
 import ai_generator.abstract as abstract
-import ai_generator.openai_utils as openai_utils
+import ai_generator.markup as markup
 import ai_generator.presentation as presentation
+import ai_generator.prompts as prompts
 
 import config
 
 import database
 
+import delivery
+
+import generation
+
+import http_pool
+
+import jobs
+
+import memory_budget
+
+import menu
+
+import metrics
+
+import rate_limiter
+
 import telegram
 from telegram import (
     BotCommand,
@@ -26,6 +46,7 @@ from telegram.constants import ParseMode
 from telegram.ext import (
     Application,
     ApplicationBuilder,
+    ApplicationHandlerStop,
     CallbackContext,
     CallbackQueryHandler,
     CommandHandler,
@@ -33,20 +54,44 @@ from telegram.ext import (
     ConversationHandler,
     MessageHandler,
     PreCheckoutQueryHandler,
+    TypeHandler,
     filters,
 )
 
+import tracing
+
+import usage
+
+import warmup
+
+import webhook
+
 
 # setup
 db = database.Database()
 logger = logging.getLogger(__name__)
+# holds the leases of the checkpointed jobs this process resumes
+instance_id = uuid.uuid4().hex
 
 CHAT_MODES = config.chat_modes
+BALANCE_HISTORY_DAYS = 7
+
+if config.job_backend == "mongo":
+    generation_queue = jobs.MongoGenerationQueue(db, config.generation_queue_size, config.max_active_jobs_per_user)
+else:
+    generation_queue = jobs.GenerationQueue(
+        config.generation_workers,
+        config.generation_queue_size,
+        config.max_active_jobs_per_user,
+    )
+
+inbound_limiter = rate_limiter.InboundRateLimiter(config.rate_limits, db if config.rate_limit_shared else None)
 
 HELP_MESSAGE = """Commands:
 ⚪ /menu – Show menu
 ⚪ /mode – Select mode
 ⚪ /balance – Show balance
+⚪ /cancel – Cancel requests in progress
 ⚪ /help – Show help
 """
 
@@ -56,8 +101,65 @@ async def post_init(application: Application):
         BotCommand("/menu", "Show menu"),
         BotCommand("/mode", "Select mode"),
         BotCommand("/balance", "Show balance"),
+        BotCommand("/cancel", "Cancel requests in progress"),
         BotCommand("/help", "Show help"),
     ])
+    if config.metrics_port:
+        application.bot_data["metrics_runner"] = await metrics.start_server(config.metrics_host, config.metrics_port)
+    await warmup.warm_up(db)
+    db.ensure_deck_indexes()
+    if config.rate_limit_shared:
+        db.ensure_rate_limit_indexes()
+    usage.recorder.start(db)
+    generation_queue.start(functools.partial(run_local_job, application.bot),
+                           functools.partial(db.enqueue_job, status="checkpointed"),
+                           admit=memory_budget.budget.acquire, release=memory_budget.budget.release)
+    if isinstance(generation_queue, jobs.GenerationQueue):
+        claim = functools.partial(db.claim_checkpointed_job, instance_id, config.job_lease_seconds,
+                                  config.job_max_attempts)
+        for job in iter(claim, None):
+            logger.info(f"Resuming checkpointed job {job['id']} (attempt {job['attempts']})")
+            generation_queue.resume(job)
+        db.fail_abandoned_jobs(config.job_max_attempts)
+    metrics.QUEUE_DEPTH.set_function(generation_queue.depth)
+
+
+async def run_local_job(bot: telegram.Bot, job: dict):
+    if job.get("status") != "resumed":
+        await generation.run_job(bot, db, job)
+        return
+
+    # a resumed job is stored, so it renews its lease while it runs and ends with a final status
+    task = asyncio.create_task(generation.run_job(bot, db, job))
+    try:
+        while not task.done():
+            db.renew_job_lease(job["id"], instance_id, config.job_lease_seconds)
+            await asyncio.wait({task}, timeout=config.job_lease_seconds / 3)
+        await task
+    except asyncio.CancelledError:
+        task.cancel()
+        await asyncio.wait({task})
+        # a drained job is checkpointed again instead
+        if not job.get("checkpointed"):
+            db.set_job_status(job["id"], instance_id, "cancelled")
+        raise
+    except Exception:
+        db.set_job_status(job["id"], instance_id, "failed")
+        raise
+    else:
+        db.set_job_status(job["id"], instance_id, "done")
+
+
+async def post_stop(application: Application):
+    # runs before the bot is shut down, so draining jobs can still send their documents
+    await generation_queue.drain(config.drain_timeout)
+
+
+async def post_shutdown(application: Application):
+    await usage.recorder.close()
+    await http_pool.close()
+    if "metrics_runner" in application.bot_data:
+        await application.bot_data["metrics_runner"].cleanup()
 
 
 def split_text_into_chunks(text, chunk_size):
@@ -130,41 +232,10 @@ async def set_chat_mode_handle(update: Update, context: CallbackContext):
 
 SELECTING_ACTION, SELECTING_MENU, INPUT_TOPIC, INPUT_PROMPT = map(chr, range(4))
 END = ConversationHandler.END
-PRESENTATION = "Presentation"
-ABSTRACT = "Abstract"
-LANGUAGES = ['English', 'Russian', 'German', 'French', 'Italian', 'Spanish', 'Ukrainian', 'Polish', 'Turkish',
-             'Romanian', 'Dutch', 'Greek', 'Czech', 'Portuguese', 'Swedish', 'Hungarian', 'Serbian', 'Bulgarian',
-             'Danish', 'Norwegian', 'Finnish', 'Slovak', 'Croatian', 'Arabic', 'Hebrew', 'Lithuanian', 'Slovenian',
-             'Bengali', 'Chinese', 'Persian', 'Indonesian', 'Latvian', 'Tamil', 'Japanese', 'Estonian', 'Telugu',
-             'Korean', 'Thai', 'Icelandic', 'Vietnamese']
-LANGUAGES_EMOJI = ['🇬🇧', '🏳️', '🇩🇪', '🇫🇷', '🇮🇹', '🇪🇸', '🇺🇦', '🇵🇱', '🇹🇷', '🇷🇴', '🇳🇱', '🇬🇷',
-                   '🇨🇿', '🇵🇹', '🇸🇪', '🇭🇺', '🇷🇸', '🇧🇬', '🇩🇰', '🇳🇴', '🇫🇮', '🇸🇰', '🇭🇷', '🇸🇦',
-                   '🇮🇱', '🇱🇹', '🇸🇮', '🇧🇩', '🇨🇳', '🇮🇷', '🇮🇩', '🇱🇻', '🇮🇳', '🇯🇵', '🇪🇪', '🇮🇳',
-                   '🇰🇷', '🇹🇭', '🇮🇸', '🇻🇳']
-TEMPLATES = ["Mountains", "Organic", "East Asia", "Explore", "3D Float", "Luminous", "Academic", "Snowflake", "Floral",
-             "Minimal"]
-TEMPLATES_EMOJI = ["🗻", "🌿", "🐼", "🧭", "🌑", "🕯️", "🎓", "❄️", "🌺", "◽"]
-TYPES = ["Fun", "Serious", "Creative", "Informative", "Inspirational", "Motivational", "Educational", "Historical",
-         "Romantic", "Mysterious", "Relaxing", "Adventurous", "Humorous", "Scientific", "Musical", "Horror", "Fantasy",
-         "Action", "Dramatic", "Satirical", "Poetic", "Thriller", "Sports", "Comedy", "Biographical", "Political",
-         "Magical", "Mystery", "Travel", "Documentary", "Crime", "Cooking"]
-TYPES_EMOJI = ["😂", "😐", "🎨", "📚", "🌟", "💪", "👨‍🎓", "🏛️", "💕", "🕵️‍♂️", "🧘‍♀️", "🗺️", "🤣", "🔬", "🎵", "😱", "🦄",
-               "💥", "😮", "🙃", "🌸", "😰", "⚽", "😆", "📜", "🗳️", "✨", "🔮", "✈️", "🎥", "🚓", "🍽️"]
-COUNTS = [str(i) for i in range(3, 27)]
-COUNTS_EMOJI = ["", "", "", "", "", "", "", "", "", "", "", "", "", "", "", "", "", "", "", "", "", "", "", ""]
-BACK = "⬅️Back"
 (
-    PRESENTATION_LANGUAGE_CHOICE,
-    ABSTRACT_LANGUAGE_CHOICE,
-    TEMPLATE_CHOICE,
-    PRESENTATION_TYPE_CHOICE,
-    ABSTRACT_TYPE_CHOICE,
-    COUNT_SLIDE_CHOICE,
-    TOPIC_CHOICE,
-    API_RESPONSE,
     START_OVER,
     MESSAGE_ID,
-) = map(chr, range(10, 20))
+) = map(chr, range(10, 12))
 
 
 async def menu_handle(update: Update, context: CallbackContext) -> str:
@@ -179,192 +250,142 @@ async def menu_handle(update: Update, context: CallbackContext) -> str:
         except telegram.error.BadRequest:
             pass
 
-    keyboard = [
-        [
-            InlineKeyboardButton(f"💻{PRESENTATION}", callback_data=PRESENTATION)
-        ],
-        [
-            InlineKeyboardButton(f"📝{ABSTRACT}", callback_data=ABSTRACT)
-        ]
-    ]
     if context.user_data.get(START_OVER):
         await update.callback_query.answer()
-        await update.callback_query.edit_message_text("Menu:", reply_markup=InlineKeyboardMarkup(keyboard))
+        await update.callback_query.edit_message_text("Menu:", reply_markup=menu.MENU_KEYBOARD)
     else:
-        context.chat_data[MESSAGE_ID] = await update.message.reply_text("Menu:",
-                                                                        reply_markup=InlineKeyboardMarkup(keyboard))
+        context.chat_data[MESSAGE_ID] = await update.message.reply_text("Menu:", reply_markup=menu.MENU_KEYBOARD)
     context.user_data[START_OVER] = False
     return SELECTING_ACTION
 
 
-async def generate_keyboard(page, word_array, emoji_array, callback):
-    keyboard = []
-    per_page = 12
-    for i, words in enumerate(word_array[(page-1)*per_page:page*per_page]):
-        if i % 2 == 0:
-            keyboard.append([InlineKeyboardButton(emoji_array[i+((page-1)*per_page)] + words,
-                                                  callback_data=f"{callback}{words}")])
-        else:
-            keyboard[-1].append(InlineKeyboardButton(emoji_array[i+((page-1)*per_page)] + words,
-                                                     callback_data=f"{callback}{words}"))
-    if len(word_array) > per_page and page == 1:
-        keyboard.append([InlineKeyboardButton(">>", callback_data=f"page_{callback}{page+1}")])
-    elif page != 1:
-        if len(word_array) > page*per_page:
-            keyboard.append([
-                InlineKeyboardButton("<<", callback_data=f"page_{callback}{page-1}"),
-                InlineKeyboardButton(">>", callback_data=f"page_{callback}{page+1}")
-            ])
-        else:
-            keyboard.append([InlineKeyboardButton("<<", callback_data=f"page_{callback}{page-1}")])
-    keyboard.append([InlineKeyboardButton(text=BACK, callback_data=str(END))])
-    return InlineKeyboardMarkup(keyboard)
-
-
-async def presentation_language_callback(update: Update, context: CallbackContext) -> str:
-    await register_user_if_not_exists(update.callback_query, context, update.callback_query.from_user)
-    query = update.callback_query
-    data = query.data
-    page = 1
-    if data.startswith("page_language_"):
-        page = int(data.replace("page_language_", ""))
-    text = "Choose language of your Presentation:"
-    reply_markup = await generate_keyboard(page, LANGUAGES, LANGUAGES_EMOJI, "language_")
-    await query.answer()
-    await query.edit_message_text(text=text, reply_markup=reply_markup)
-    return SELECTING_MENU
-
-
-async def abstract_language_callback(update: Update, context: CallbackContext) -> str:
+async def menu_callback(update: Update, context: CallbackContext) -> str:
     await register_user_if_not_exists(update.callback_query, context, update.callback_query.from_user)
     query = update.callback_query
-    data = query.data
-    page = 1
-    if data.startswith("page_language_"):
-        page = int(data.replace("page_language_", ""))
-    text = "Choose language of your Abstract:"
-    reply_markup = await generate_keyboard(page, LANGUAGES, LANGUAGES_EMOJI, "language_")
+    flow, step_index, value, page = menu.parse_callback_data(query.data)
+    steps = menu.FLOWS[flow].steps
+    choices = context.user_data.setdefault(flow, {})
+    if value == menu.DONE:
+        step_index, page = step_index + 1, 1
+    elif value is not None and steps[step_index].multi:
+        # toggle the option and stay on its page
+        selected = choices.setdefault(steps[step_index].name, [])
+        option = steps[step_index].options[value]
+        if option in selected:
+            selected.remove(option)
+        else:
+            selected.append(option)
+        page = value // menu.PER_PAGE + 1
+    elif value is not None:
+        choices[steps[step_index].name] = steps[step_index].options[value]
+        step_index, page = step_index + 1, 1
+        if step_index < len(steps) and steps[step_index].multi:
+            choices[steps[step_index].name] = []
     await query.answer()
-    await query.edit_message_text(text=text, reply_markup=reply_markup)
-    return SELECTING_MENU
 
+    if step_index == len(steps):
+        await query.edit_message_text(text=menu.FLOWS[flow].topic_text)
+        if MESSAGE_ID in context.chat_data:
+            del context.chat_data[MESSAGE_ID]
+        return INPUT_TOPIC
 
-async def presentation_template_callback(update: Update, context: CallbackContext) -> str:
-    await register_user_if_not_exists(update.callback_query, context, update.callback_query.from_user)
-    query = update.callback_query
-    data = query.data
-    page = 1
-    if data.startswith("page_template_"):
-        page = int(data.replace("page_template_", ""))
+    step = steps[step_index]
+    if step.multi:
+        reply_markup = menu.build_step_keyboard(flow, step_index, step, page, choices.get(step.name, []))
     else:
-        context.user_data[PRESENTATION_LANGUAGE_CHOICE] = data
-    text = "Choose template of your Presentation:"
-    reply_markup = await generate_keyboard(page, TEMPLATES, TEMPLATES_EMOJI, "template_")
-    await query.answer()
-    await query.edit_message_text(text=text, reply_markup=reply_markup)
+        reply_markup = menu.KEYBOARDS[(flow, step_index, page)]
+    await query.edit_message_text(text=step.text, reply_markup=reply_markup)
     return SELECTING_MENU
 
 
-async def presentation_type_callback(update: Update, context: CallbackContext) -> str:
-    await register_user_if_not_exists(update.callback_query, context, update.callback_query.from_user)
-    query = update.callback_query
-    data = query.data
-    page = 1
-    if data.startswith("page_type_"):
-        page = int(data.replace("page_type_", ""))
-    else:
-        context.user_data[TEMPLATE_CHOICE] = data
-    text = "Choose type of your Presentation:"
-    reply_markup = await generate_keyboard(page, TYPES, TYPES_EMOJI, "type_")
-    await query.answer()
-    await query.edit_message_text(text=text, reply_markup=reply_markup)
-    return SELECTING_MENU
-
+async def submit_generation_job(update: Update, job):
+    job["id"] = uuid.uuid4().hex
+    try:
+        generation_queue.check_admission(job["user_id"])
+    except jobs.QueueFullError:
+        await update.effective_message.reply_text("System is currently overloaded. Please try again later😊")
+        return
+    except jobs.UserJobLimitError:
+        await update.effective_message.reply_text(
+            "Please wait until your previous requests are done or /cancel them😊")
+        return
 
-async def abstract_type_callback(update: Update, context: CallbackContext) -> str:
-    await register_user_if_not_exists(update.callback_query, context, update.callback_query.from_user)
-    query = update.callback_query
-    data = query.data
-    page = 1
-    if data.startswith("page_type_"):
-        page = int(data.replace("page_type_", ""))
+    job["queue_position"] = generation_queue.position()
+    if job["queue_position"] > 0:
+        text = f"⌛ You are #{job['queue_position']} in the queue"
     else:
-        context.user_data[ABSTRACT_LANGUAGE_CHOICE] = data
-    text = "Choose type of your Abstract:"
-    reply_markup = await generate_keyboard(page, TYPES, TYPES_EMOJI, "type_")
-    await query.answer()
-    await query.edit_message_text(text=text, reply_markup=reply_markup)
-    return SELECTING_MENU
+        text = "⌛"
+    status_message = await update.effective_message.reply_text(text, reply_to_message_id=job["message_id"])
+    job["status_message_id"] = status_message.message_id
+    if tracing.profiler.claim():
+        job["profile"] = True
+    try:
+        generation_queue.submit(job)
+    except (jobs.QueueFullError, jobs.UserJobLimitError):
+        await status_message.edit_text("System is currently overloaded. Please try again later😊")
 
 
-async def presentation_slide_count_callback(update: Update, context: CallbackContext) -> str:
-    await register_user_if_not_exists(update.callback_query, context, update.callback_query.from_user)
+async def regenerate_slide_callback(update: Update, context: CallbackContext):
     query = update.callback_query
-    data = query.data
-    page = 1
-    if data.startswith("page_slide_count_"):
-        page = int(data.replace("page_slide_count_", ""))
-    else:
-        context.user_data[PRESENTATION_TYPE_CHOICE] = data
-    text = "Choose an approximate number of slides for your Presentation:"
-    reply_markup = await generate_keyboard(page, COUNTS, COUNTS_EMOJI, "slide_count_")
+    await register_user_if_not_exists(query, context, query.from_user)
     await query.answer()
-    await query.edit_message_text(text=text, reply_markup=reply_markup)
-    return SELECTING_MENU
+    user_id = query.from_user.id
+    deck_id, slide = menu.parse_regenerate_data(query.data)
+    deck = db.get_deck(deck_id, with_images=False)
+    if deck is None or deck["user_id"] != user_id:
+        await query.edit_message_reply_markup(reply_markup=None)
+        return
 
+    slides = await presentation.parse_slides(deck["answer"])
+    if slide is None:
+        titles = [parsed_slide["title"] for parsed_slide in slides]
+        await query.edit_message_reply_markup(reply_markup=menu.build_slides_keyboard(deck_id, titles))
+    elif slide == END:
+        await query.edit_message_reply_markup(reply_markup=menu.build_regenerate_keyboard(deck_id))
+    elif db.get_user_attribute(user_id, "n_available_tokens") > 0:
+        await query.edit_message_reply_markup(reply_markup=menu.build_regenerate_keyboard(deck_id))
+        await submit_generation_job(update, {
+            "kind": "slide",
+            "user_id": user_id,
+            "chat_id": query.message.chat_id,
+            "message_id": query.message.message_id,
+            "deck_id": deck_id,
+            "slide": slide,
+            "template": deck["template"],
+            "variants": deck["variants"],
+            "count": len(slides),
+        })
+    else:
+        await query.message.reply_text("You have not enough tokens.")
 
-async def presentation_topic_callback(update: Update, context: CallbackContext) -> str:
-    await register_user_if_not_exists(update.callback_query, context, update.callback_query.from_user)
-    query = update.callback_query
-    data = query.data
-    text = "Whats topic of your Presentation?"
-    context.user_data[COUNT_SLIDE_CHOICE] = data
-    await query.answer()
-    await query.edit_message_text(text=text)
-    if MESSAGE_ID in context.chat_data:
-        del context.chat_data[MESSAGE_ID]
-    return INPUT_TOPIC
 
+async def cancel_handle(update: Update, context: CallbackContext):
+    await register_user_if_not_exists(update, context, update.message.from_user)
+    user_id = update.message.from_user.id
+    db.set_user_attribute(user_id, "last_interaction", datetime.now())
 
-async def abstract_topic_callback(update: Update, context: CallbackContext) -> str:
-    await register_user_if_not_exists(update.callback_query, context, update.callback_query.from_user)
-    query = update.callback_query
-    data = query.data
-    text = "Whats topic of your Abstract?"
-    context.user_data[ABSTRACT_TYPE_CHOICE] = data
-    await query.answer()
-    await query.edit_message_text(text=text)
-    if MESSAGE_ID in context.chat_data:
-        del context.chat_data[MESSAGE_ID]
-    return INPUT_TOPIC
+    cancelled_jobs = generation_queue.cancel_user_jobs(user_id)
+    for job in cancelled_jobs:
+        try:
+            await context.bot.delete_message(chat_id=job["chat_id"], message_id=job["status_message_id"])
+        except telegram.error.BadRequest:
+            pass
+    if cancelled_jobs:
+        await update.message.reply_text(f"Cancelled {len(cancelled_jobs)} request(s)😊")
+    else:
+        await update.message.reply_text("You have no requests in progress😊")
 
 
-async def auto_generate_presentation(update: Update, context: CallbackContext, user_id, message_id, prompt, template_choice):
-    notification_message = await update.message.reply_text("⌛", reply_to_message_id=message_id)
+async def profile_handle(update: Update, context: CallbackContext):
     try:
-        response, n_used_tokens = await openai_utils.process_prompt(prompt)
-    except OverflowError:
-        await notification_message.delete()
-        await update.message.reply_text(text="System is currently overloaded. Please try again. 😊",
-                                        reply_to_message_id=message_id)
-        return END
-    except RuntimeError:
-        await notification_message.delete()
-        await update.message.reply_text(text="Some error happened. Please try again. 😊",
-                                        reply_to_message_id=message_id)
-        return END
+        n_jobs = int(context.args[0]) if context.args else 1
     except ValueError:
-        await notification_message.delete()
-        await update.message.reply_text(text="Your Presentation is too big. Please try again😊",
-                                        reply_to_message_id=message_id)
-        return END
-    available_tokens = db.get_user_attribute(user_id, "n_available_tokens")
-    db.set_user_attribute(user_id, "n_available_tokens", available_tokens - n_used_tokens)
-    used_tokens = db.get_user_attribute(user_id, "n_used_tokens")
-    db.set_user_attribute(user_id, "n_used_tokens", n_used_tokens + used_tokens)
-    pptx_bytes, pptx_title = await presentation.generate_ppt(response, template_choice)
-    await update.message.reply_document(document=pptx_bytes, filename=pptx_title)
-    await notification_message.delete()
+        await update.message.reply_text("Usage: /profile [number of jobs]")
+        return
+    tracing.profiler.arm(n_jobs)
+    await update.message.reply_text(f"Profiling the next {n_jobs} job(s) submitted to this bot, their profiles are "
+                                    f"saved to {config.profile_dir} of the process that runs them and also count "
+                                    f"the jobs running alongside")
 
 
 async def presentation_save_input(update: Update, context: CallbackContext):
@@ -376,19 +397,36 @@ async def presentation_save_input(update: Update, context: CallbackContext):
     message_id = update.message.message_id
     topic_choice = update.message.text
     user_mode = db.get_user_attribute(user_id, "current_chat_mode")
-    language_choice = user_data[PRESENTATION_LANGUAGE_CHOICE].replace("language_", "")
-    template_choice = user_data[TEMPLATE_CHOICE].replace("template_", "")
-    type_choice = user_data[PRESENTATION_TYPE_CHOICE].replace("type_", "")
-    count_slide_choice = user_data[COUNT_SLIDE_CHOICE].replace("slide_count_", "")
-    prompt = await presentation.generate_ppt_prompt(language_choice, type_choice, count_slide_choice, topic_choice)
+    choices = user_data[menu.PRESENTATION]
+    language_choice = choices["language"]
+    template_choice = choices["template"]
+    type_choice = choices["type"]
+    count_slide_choice = choices["count"]
     if user_mode == "auto":
         available_tokens = db.get_user_attribute(user_id, "n_available_tokens")
         if available_tokens > 0:
-            loop = asyncio.get_event_loop()
-            loop.create_task(auto_generate_presentation(update, context, user_id, message_id, prompt, template_choice))
+            job_prompt = await prompts.build(menu.PRESENTATION, language=language_choice, emotion_type=type_choice,
+                                             slide_length=count_slide_choice, topic=topic_choice)
+            await submit_generation_job(update, {
+                "kind": "presentation",
+                "user_id": user_id,
+                "chat_id": update.message.chat_id,
+                "message_id": message_id,
+                "prompt": job_prompt.user,
+                "system_prompt": job_prompt.system,
+                "prompt_variant": job_prompt.variant,
+                "language": language_choice,
+                "type": type_choice,
+                "topic": topic_choice,
+                "template": template_choice,
+                "count": int(count_slide_choice),
+                "variants": [variant for variant in choices.get("variants", []) if variant != template_choice],
+            })
         else:
             await update.message.reply_text("You have not enough tokens.")
     else:
+        prompt = await presentation.generate_ppt_prompt(language_choice, type_choice, count_slide_choice,
+                                                        topic_choice)
         try:
             await update.message.reply_text(text="`" + prompt + "`", parse_mode=ParseMode.MARKDOWN_V2)
         except telegram.error.BadRequest:
@@ -405,34 +443,6 @@ async def presentation_save_input(update: Update, context: CallbackContext):
     return END
 
 
-async def auto_generate_abstract(update: Update, context: CallbackContext, user_id, message_id, prompt):
-    notification_message = await update.message.reply_text("⌛", reply_to_message_id=message_id)
-    try:
-        response, n_used_tokens = await openai_utils.process_prompt(prompt)
-    except OverflowError:
-        await notification_message.delete()
-        await update.message.reply_text(text="System is currently overloaded. Please try again😊",
-                                        reply_to_message_id=message_id)
-        return END
-    except RuntimeError:
-        await notification_message.delete()
-        await update.message.reply_text(text="Some error happened. Please try again😊",
-                                        reply_to_message_id=message_id)
-        return END
-    except ValueError:
-        await notification_message.delete()
-        await update.message.reply_text(text="Your Abstract is too big. Please try again😊",
-                                        reply_to_message_id=message_id)
-        return END
-    available_tokens = db.get_user_attribute(user_id, "n_available_tokens")
-    db.set_user_attribute(user_id, "n_available_tokens", available_tokens - n_used_tokens)
-    used_tokens = db.get_user_attribute(user_id, "n_used_tokens")
-    db.set_user_attribute(user_id, "n_used_tokens", n_used_tokens + used_tokens)
-    docx_bytes, docx_title = await abstract.generate_docx(response)
-    await update.message.reply_document(document=docx_bytes, filename=docx_title)
-    await notification_message.delete()
-
-
 async def abstract_save_input(update: Update, context: CallbackContext):
     if update.edited_message is not None:
         return
@@ -442,17 +452,30 @@ async def abstract_save_input(update: Update, context: CallbackContext):
     message_id = update.message.message_id
     topic_choice = update.message.text
     user_mode = db.get_user_attribute(user_id, "current_chat_mode")
-    language_choice = user_data[ABSTRACT_LANGUAGE_CHOICE].replace("language_", "")
-    type_choice = user_data[ABSTRACT_TYPE_CHOICE].replace("type_", "")
-    prompt = await abstract.generate_docx_prompt(language_choice, type_choice, topic_choice)
+    choices = user_data[menu.ABSTRACT]
+    language_choice = choices["language"]
+    type_choice = choices["type"]
     if user_mode == "auto":
         available_tokens = db.get_user_attribute(user_id, "n_available_tokens")
         if available_tokens > 0:
-            loop = asyncio.get_event_loop()
-            loop.create_task(auto_generate_abstract(update, context, user_id, message_id, prompt))
+            job_prompt = await prompts.build(menu.ABSTRACT, language=language_choice, emotion_type=type_choice,
+                                             topic=topic_choice)
+            await submit_generation_job(update, {
+                "kind": "abstract",
+                "user_id": user_id,
+                "chat_id": update.message.chat_id,
+                "message_id": message_id,
+                "prompt": job_prompt.user,
+                "system_prompt": job_prompt.system,
+                "prompt_variant": job_prompt.variant,
+                "language": language_choice,
+                "type": type_choice,
+                "topic": topic_choice,
+            })
         else:
             await update.message.reply_text("You have not enough tokens😊")
     else:
+        prompt = await abstract.generate_docx_prompt(language_choice, type_choice, topic_choice)
         try:
             await update.message.reply_text(text="`" + prompt + "`", parse_mode=ParseMode.MARKDOWN_V2)
         except telegram.error.BadRequest:
@@ -474,12 +497,14 @@ async def presentation_prompt_callback(update: Update, context: CallbackContext)
         await edited_message_handle(update, context)
         return
     await register_user_if_not_exists(update, context, update.message.from_user)
-    api_response = update.message.text
+    api_response = markup.repair_presentation(update.message.text).reply
     user_data = context.user_data
-    template_choice = user_data[TEMPLATE_CHOICE].replace("template_", "")
+    template_choice = user_data[menu.PRESENTATION]["template"]
     try:
-        pptx_bytes, pptx_title = await presentation.generate_ppt(api_response, template_choice)
-        await update.message.reply_document(document=pptx_bytes, filename=pptx_title)
+        pptx_file, pptx_title = await presentation.generate_ppt(api_response, template_choice,
+                                                                  image_deadline=config.image_deadline)
+        with pptx_file:
+            await delivery.send_document(context.bot, db, pptx_file, pptx_title, update.effective_chat.id)
     except IndexError:
         await update.message.reply_text("Check inserted data and try again😊")
         return INPUT_PROMPT
@@ -491,10 +516,11 @@ async def abstract_prompt_callback(update: Update, context: CallbackContext):
         await edited_message_handle(update, context)
         return
     await register_user_if_not_exists(update, context, update.message.from_user)
-    api_response = update.message.text
+    api_response = markup.repair_abstract(update.message.text).reply
     try:
-        docx_bytes, docx_title = await abstract.generate_docx(api_response)
-        await update.message.reply_document(document=docx_bytes, filename=docx_title)
+        docx_file, docx_title = await abstract.generate_docx(api_response, image_deadline=config.image_deadline)
+        with docx_file:
+            await delivery.send_document(context.bot, db, docx_file, docx_title, update.effective_chat.id)
     except IndexError:
         await update.message.reply_text("Check inserted data and try again😊")
         return INPUT_PROMPT
@@ -519,6 +545,13 @@ async def show_balance_handle(update: Update, context: CallbackContext):
 
     text = f"🟢Your have <b>{n_available_tokens}</b> tokens left\n"
     text += f"You totally spent <b>{n_used_tokens}</b> tokens\n\n"
+    history = usage.daily_history(db, user_id, BALANCE_HISTORY_DAYS)
+    if history:
+        text += f"Last {BALANCE_HISTORY_DAYS} days:\n"
+        for rollup in history:
+            n_done = rollup.get("status", {}).get("done", 0)
+            text += f"{rollup['start']:%d.%m} — <b>{rollup.get('tokens', 0)}</b> tokens, {n_done} request(s)\n"
+        text += "\n"
 
     keyboard = [
         [
@@ -589,6 +622,40 @@ async def successful_payment_handle(update: Update, context: CallbackContext):
         pass
 
 
+def classify_update(update: Update):
+    """The action class an update is rate limited by, None for updates that are never limited."""
+    if update.callback_query is not None:
+        if (update.callback_query.data or "").startswith("buy_tokens_"):
+            return rate_limiter.PAYMENT
+        return rate_limiter.CALLBACK
+    if update.pre_checkout_query is not None:
+        return rate_limiter.PAYMENT
+    # successful payments are never dropped, the user has already paid for them
+    message = update.message or update.edited_message
+    if message is not None and message.text and not message.text.startswith("/"):
+        return rate_limiter.TOPIC
+    return None
+
+
+async def rate_limit_handle(update: Update, context: CallbackContext):
+    action = classify_update(update)
+    if action is None or update.effective_user is None:
+        return
+    retry_after = await inbound_limiter.hit(update.effective_user.id, action)
+    if not retry_after:
+        return
+    metrics.RATE_LIMITED.inc(action=action)
+    text = f"⏳ Too many requests, please try again in {math.ceil(retry_after)} s😊"
+    if update.pre_checkout_query is not None:
+        await update.pre_checkout_query.answer(ok=False, error_message=text)
+    elif update.callback_query is not None:
+        # a callback query has to be answered anyway, or its button keeps spinning
+        await update.callback_query.answer(text)
+    elif inbound_limiter.should_notify(update.effective_user.id, action):
+        await update.effective_message.reply_text(text)
+    raise ApplicationHandlerStop
+
+
 async def edited_message_handle(update: Update, context: CallbackContext):
     text = "🥲 Unfortunately, message <b>editing</b> is not supported"
     await update.edited_message.reply_text(text, parse_mode=ParseMode.HTML)
@@ -596,6 +663,7 @@ async def edited_message_handle(update: Update, context: CallbackContext):
 
 async def error_handle(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
     logger.error(msg="Exception while handling an update:", exc_info=context.error)
+    metrics.ERRORS.inc(type=type(context.error).__name__)
     # send error to the chat for test
     try:
         # collect error message
@@ -612,24 +680,39 @@ async def error_handle(update: object, context: ContextTypes.DEFAULT_TYPE) -> No
         # split text into multiple messages due to 4096 character limit
         for message_chunk in split_text_into_chunks(message, 4096):
             try:
-                await context.bot.send_message(update.effective_chat.id, message_chunk, parse_mode=ParseMode.HTML)
+                await context.bot.send_message(update.effective_chat.id, message_chunk, parse_mode=ParseMode.HTML,
+                                               rate_limit_args=rate_limiter.LOW_PRIORITY)
             except telegram.error.BadRequest:
                 # answer has invalid characters, so we send it without parse_mode
-                await context.bot.send_message(update.effective_chat.id, message_chunk)
+                await context.bot.send_message(update.effective_chat.id, message_chunk,
+                                               rate_limit_args=rate_limiter.LOW_PRIORITY)
     except Exception:
-        await context.bot.send_message(update.effective_chat.id, "Some error in error handler")
+        await context.bot.send_message(update.effective_chat.id, "Some error in error handler",
+                                       rate_limit_args=rate_limiter.LOW_PRIORITY)
 
 
-def run_bot() -> None:
+def build_rate_limiter() -> rate_limiter.OutboundRateLimiter:
+    return rate_limiter.OutboundRateLimiter(config.outbound_global_rate, config.outbound_chat_rate,
+                                            config.outbound_chat_burst)
+
+
+def build_application() -> Application:
     application = (
         ApplicationBuilder()
         .token(config.telegram_token)
+        .base_url(config.telegram_api_url)
         .concurrent_updates(True)
+        .rate_limiter(build_rate_limiter())
         .post_init(post_init)
+        .post_stop(post_stop)
+        .post_shutdown(post_shutdown)
         .build()
     )
 
     # add handlers
+    # runs before every other group, so that updates over the rate limit reach neither MongoDB nor OpenAI
+    application.add_handler(TypeHandler(Update, rate_limit_handle), group=-1)
+
     if len(config.allowed_telegram_usernames) == 0:
         user_filter = filters.ALL
     else:
@@ -637,66 +720,39 @@ def run_bot() -> None:
 
     application.add_handler(CommandHandler("start", start_handle, filters=user_filter))
     application.add_handler(CommandHandler("help", help_handle, filters=user_filter))
+    application.add_handler(CommandHandler("cancel", cancel_handle, filters=user_filter))
+    application.add_handler(CommandHandler("profile", profile_handle,
+                                           filters=filters.User(username=config.admin_telegram_usernames)))
 
     application.add_handler(MessageHandler(filters.COMMAND & user_filter, message_handle), group=2)
 
     application.add_handler(CommandHandler("mode", show_chat_modes_handle, filters=user_filter))
     application.add_handler(CallbackQueryHandler(set_chat_mode_handle, pattern="^set_chat_mode"))
 
-    presentation_conv = ConversationHandler(
-        entry_points=[CallbackQueryHandler(presentation_language_callback, pattern=f"^{PRESENTATION}$")],
-        states={
-            SELECTING_MENU: [
-                CallbackQueryHandler(presentation_language_callback, pattern="^page_language_"),
-                CallbackQueryHandler(presentation_template_callback, pattern="^language_"),
-                CallbackQueryHandler(presentation_template_callback, pattern="^page_template_"),
-                CallbackQueryHandler(presentation_type_callback, pattern="^template_"),
-                CallbackQueryHandler(presentation_type_callback, pattern="^page_type_"),
-                CallbackQueryHandler(presentation_slide_count_callback, pattern="^type_"),
-                CallbackQueryHandler(presentation_slide_count_callback, pattern="^page_slide_count_"),
-                CallbackQueryHandler(presentation_topic_callback, pattern="^slide_count_"),
-                             ],
-            INPUT_TOPIC: [MessageHandler(filters.TEXT & ~filters.COMMAND, presentation_save_input)],
-            INPUT_PROMPT: [MessageHandler(filters.TEXT & ~filters.COMMAND, presentation_prompt_callback)],
-        },
-        fallbacks=[
-            CallbackQueryHandler(end_second_level, pattern=f"^{str(END)}$"),
-            CommandHandler("menu", menu_handle, filters=user_filter)
-        ],
-        map_to_parent={
-            END: SELECTING_ACTION,
-            SELECTING_ACTION: SELECTING_ACTION,
-        },
-        allow_reentry=True,
-    )
-
-    abstract_conv = ConversationHandler(
-        entry_points=[CallbackQueryHandler(abstract_language_callback, pattern=f"^{ABSTRACT}$")],
-        states={
-            SELECTING_MENU: [
-                CallbackQueryHandler(abstract_language_callback, pattern="^page_language_"),
-                CallbackQueryHandler(abstract_type_callback, pattern="^language_"),
-                CallbackQueryHandler(abstract_type_callback, pattern="^page_type_"),
-                CallbackQueryHandler(abstract_topic_callback, pattern="^type_")
-                             ],
-            INPUT_TOPIC: [MessageHandler(filters.TEXT & ~filters.COMMAND, abstract_save_input)],
-            INPUT_PROMPT: [MessageHandler(filters.TEXT & ~filters.COMMAND, abstract_prompt_callback)],
-        },
-        fallbacks=[
-            CallbackQueryHandler(end_second_level, pattern=f"^{str(END)}$"),
-            CommandHandler("menu", menu_handle, filters=user_filter)
-        ],
-        map_to_parent={
-            END: SELECTING_ACTION,
-            SELECTING_ACTION: SELECTING_ACTION,
-        },
-        allow_reentry=True,
-    )
-
-    selection_handlers = [
-        presentation_conv,
-        abstract_conv,
-    ]
+    topic_handlers = {
+        menu.PRESENTATION: (presentation_save_input, presentation_prompt_callback),
+        menu.ABSTRACT: (abstract_save_input, abstract_prompt_callback),
+    }
+    selection_handlers = []
+    for flow, (save_input_handle, prompt_handle) in topic_handlers.items():
+        flow_callback_handler = CallbackQueryHandler(menu_callback, pattern=menu.is_flow_callback(flow))
+        selection_handlers.append(ConversationHandler(
+            entry_points=[flow_callback_handler],
+            states={
+                SELECTING_MENU: [flow_callback_handler],
+                INPUT_TOPIC: [MessageHandler(filters.TEXT & ~filters.COMMAND, save_input_handle)],
+                INPUT_PROMPT: [MessageHandler(filters.TEXT & ~filters.COMMAND, prompt_handle)],
+            },
+            fallbacks=[
+                CallbackQueryHandler(end_second_level, pattern=f"^{str(END)}$"),
+                CommandHandler("menu", menu_handle, filters=user_filter)
+            ],
+            map_to_parent={
+                END: SELECTING_ACTION,
+                SELECTING_ACTION: SELECTING_ACTION,
+            },
+            allow_reentry=True,
+        ))
 
     menu_conv_handler = ConversationHandler(
         entry_points=[CommandHandler("menu", menu_handle, filters=user_filter)],
@@ -711,12 +767,20 @@ def run_bot() -> None:
 
     application.add_handler(CommandHandler("balance", show_balance_handle, filters=user_filter))
     application.add_handler(CallbackQueryHandler(buy_tokens_callback, pattern="^buy_tokens_"))
+    application.add_handler(CallbackQueryHandler(regenerate_slide_callback, pattern=f"^{menu.REGENERATE}\\|"))
     application.add_handler(PreCheckoutQueryHandler(pre_checkout_callback))
     application.add_handler(MessageHandler(filters.SUCCESSFUL_PAYMENT, successful_payment_handle))
 
     application.add_error_handler(error_handle)
+    return application
 
-    application.run_polling()
+
+def run_bot() -> None:
+    application = build_application()
+    if config.update_mode == "webhook":
+        asyncio.run(webhook.run_webhook(application))
+    else:
+        application.run_polling()
 
 
 if __name__ == "__main__":
@@ -16,10 +16,55 @@ config_env = dotenv.dotenv_values(config_dir / "config.env")
 
 # config parameters
 telegram_token = config_yaml["telegram_token"]
+telegram_api_url = config_yaml.get("telegram_api_url", "https://api.telegram.org/bot")
 openai_api_key = config_yaml["openai_api_key"]
 provider_token = config_yaml["provider_token"]
 allowed_telegram_usernames = config_yaml["allowed_telegram_usernames"]
 mongodb_uri = f"mongodb://mongo:{config_env['MONGODB_PORT']}"
+abstract_mode = config_yaml.get("abstract_mode", "single")
+abstract_max_concurrency = config_yaml.get("abstract_max_concurrency", 4)
+generation_workers = config_yaml.get("generation_workers", 4)
+generation_queue_size = config_yaml.get("generation_queue_size", 100)
+max_active_jobs_per_user = config_yaml.get("max_active_jobs_per_user", 2)
+job_backend = config_yaml.get("job_backend", "local")
+job_lease_seconds = config_yaml.get("job_lease_seconds", 60)
+job_max_attempts = config_yaml.get("job_max_attempts", 3)
+metrics_host = config_yaml.get("metrics_host", "127.0.0.1")
+metrics_port = config_yaml.get("metrics_port", 0)
+trace_path = config_yaml.get("trace_path", "")
+profile_dir = config_yaml.get("profile_dir", "profiles")
+admin_telegram_usernames = config_yaml.get("admin_telegram_usernames", [])
+outbound_global_rate = config_yaml.get("outbound_global_rate", 30)
+outbound_chat_rate = config_yaml.get("outbound_chat_rate", 1)
+outbound_chat_burst = config_yaml.get("outbound_chat_burst", 3)
+rate_limits = config_yaml.get("rate_limits", {
+    "callback": {"limit": 30, "window": 60},
+    "topic": {"limit": 5, "window": 60},
+    "payment": {"limit": 5, "window": 300},
+})
+rate_limit_shared = config_yaml.get("rate_limit_shared", False)
+progress_interval = config_yaml.get("progress_interval", 3)
+stream_completions = config_yaml.get("stream_completions", False)
+drain_timeout = config_yaml.get("drain_timeout", 30)
+memory_budget_bytes = config_yaml.get("memory_budget_bytes", 0)
+memory_sample_rate = config_yaml.get("memory_sample_rate", 0.05)
+max_image_bytes = config_yaml.get("max_image_bytes", 5 * 1024 * 1024)
+usage_batch_size = config_yaml.get("usage_batch_size", 50)
+usage_flush_interval = config_yaml.get("usage_flush_interval", 10)
+deck_ttl_days = config_yaml.get("deck_ttl_days", 7)
+presentation_variants = config_yaml.get("presentation_variants", False)
+prompt_variants = config_yaml.get("prompt_variants", {})
+speculative_images = config_yaml.get("speculative_images", 3)
+image_deadline = config_yaml.get("image_deadline", 20)
+completion_backends = config_yaml.get("completion_backends", [{"name": "openai", "model": "gpt-3.5-turbo"}])
+completion_hedging = config_yaml.get("completion_hedging", False)
+markup_max_continuations = config_yaml.get("markup_max_continuations", 2)
+update_mode = config_yaml.get("update_mode", "polling")
+webhook_url = config_yaml.get("webhook_url", "")
+webhook_listen = config_yaml.get("webhook_listen", "0.0.0.0")
+webhook_port = config_yaml.get("webhook_port", 8443)
+webhook_secret_token = config_yaml.get("webhook_secret_token", "")
+webhook_max_connections = config_yaml.get("webhook_max_connections", 40)
 
 # chat_modes
 with open(config_dir / "chat_modes.yml", 'r') as f:
@@ -1,10 +1,33 @@
-from datetime import datetime
+from datetime import datetime, timedelta
 from typing import Any
 
 import config
 
 import pymongo
 
+# fetched images are left out of a checkpoint bigger than this to stay clear of the 16 MB document limit
+CHECKPOINT_MAX_IMAGE_BYTES = 8 * 1024 * 1024
+# ids of the last usage batches counted in a rollup, a batch is retried long before this many more are written
+ROLLUP_BATCH_IDS = 100
+
+
+def encode_checkpoint(checkpoint: dict):
+    checkpoint = dict(checkpoint)
+    images = checkpoint.pop("images", {})
+    if sum(len(image) for image in images.values() if image) <= CHECKPOINT_MAX_IMAGE_BYTES:
+        checkpoint["images"] = {str(index): image for index, image in images.items()}
+    return checkpoint
+
+
+def decode_images(images: dict):
+    return {int(index): image for index, image in images.items()}
+
+
+def decode_job(job_dict: dict):
+    if job_dict is not None and "checkpoint" in job_dict:
+        job_dict["checkpoint"]["images"] = decode_images(job_dict["checkpoint"].get("images", {}))
+    return job_dict
+
 
 class Database:
     def __init__(self):
@@ -13,6 +36,15 @@ class Database:
 
         self.user_collection = self.db["user"]
         self.dialog_collection = self.db["dialog"]
+        self.job_collection = self.db["job"]
+        self.file_collection = self.db["file"]
+        self.deck_collection = self.db["deck"]
+        self.usage_collection = self.db["usage"]
+        self.usage_rollup_collection = self.db["usage_rollup"]
+        self.rate_limit_collection = self.db["rate_limit"]
+
+    def ping(self):
+        self.client.admin.command("ping")
 
     def check_if_user_exists(self, user_id: int, raise_exception: bool = False):
         if self.user_collection.count_documents({"_id": user_id}) > 0:
@@ -63,3 +95,203 @@ class Database:
     def set_user_attribute(self, user_id: int, key: str, value: Any):
         self.check_if_user_exists(user_id, raise_exception=True)
         self.user_collection.update_one({"_id": user_id}, {"$set": {key: value}})
+
+    def ensure_job_indexes(self):
+        self.job_collection.create_index([("status", pymongo.ASCENDING), ("created_at", pymongo.ASCENDING)])
+        self.job_collection.create_index([("user_id", pymongo.ASCENDING), ("status", pymongo.ASCENDING)])
+
+    def enqueue_job(self, job: dict, status: str = "queued"):
+        job_dict = {
+            "_id": job["id"],
+            **job,
+            "status": status,
+            "worker_id": None,
+            "lease_expires_at": None,
+            "attempts": 0,
+            "created_at": datetime.now(),
+        }
+        job_dict.pop("checkpointed", None)
+        if "checkpoint" in job:
+            job_dict["checkpoint"] = encode_checkpoint(job["checkpoint"])
+        self.job_collection.replace_one({"_id": job["id"]}, job_dict, upsert=True)
+
+    def claim_job(self, worker_id: str, lease_seconds: int, max_attempts: int):
+        now = datetime.now()
+        return decode_job(self.job_collection.find_one_and_update(
+            {
+                "$or": [
+                    {"status": "queued"},
+                    {"status": "running", "lease_expires_at": {"$lt": now}},
+                ],
+                "attempts": {"$lt": max_attempts},
+            },
+            {
+                "$set": {
+                    "status": "running",
+                    "worker_id": worker_id,
+                    "lease_expires_at": now + timedelta(seconds=lease_seconds),
+                },
+                "$inc": {"attempts": 1},
+            },
+            sort=[("created_at", pymongo.ASCENDING)],
+            return_document=pymongo.ReturnDocument.AFTER,
+        ))
+
+    def claim_checkpointed_job(self, worker_id: str, lease_seconds: int, max_attempts: int):
+        # a resumed job holds a lease like a worker's, so it is resumed again if the process resuming it dies
+        now = datetime.now()
+        return decode_job(self.job_collection.find_one_and_update(
+            {
+                "$or": [
+                    {"status": "checkpointed"},
+                    {"status": "resumed", "lease_expires_at": {"$lt": now}},
+                ],
+                "attempts": {"$lt": max_attempts},
+            },
+            {
+                "$set": {
+                    "status": "resumed",
+                    "worker_id": worker_id,
+                    "lease_expires_at": now + timedelta(seconds=lease_seconds),
+                },
+                "$inc": {"attempts": 1},
+            },
+            sort=[("created_at", pymongo.ASCENDING)],
+            return_document=pymongo.ReturnDocument.AFTER,
+        ))
+
+    def requeue_job(self, job_id: str, worker_id: str, checkpoint: dict):
+        # a drained job goes back to the queue without using up one of its attempts
+        self.job_collection.update_one(
+            {"_id": job_id, "worker_id": worker_id},
+            {
+                "$set": {
+                    "status": "queued",
+                    "worker_id": None,
+                    "lease_expires_at": None,
+                    "checkpoint": encode_checkpoint(checkpoint),
+                },
+                "$inc": {"attempts": -1},
+            },
+        )
+
+    def fail_abandoned_jobs(self, max_attempts: int):
+        self.job_collection.update_many(
+            {"status": {"$in": ["running", "resumed"]}, "lease_expires_at": {"$lt": datetime.now()},
+             "attempts": {"$gte": max_attempts}},
+            {"$set": {"status": "failed", "worker_id": None, "lease_expires_at": None}},
+        )
+
+    def renew_job_lease(self, job_id: str, worker_id: str, lease_seconds: int):
+        result = self.job_collection.update_one(
+            {"_id": job_id, "worker_id": worker_id, "status": {"$in": ["running", "resumed"]}},
+            {"$set": {"lease_expires_at": datetime.now() + timedelta(seconds=lease_seconds)}},
+        )
+        return result.modified_count == 1
+
+    def set_job_status(self, job_id: str, worker_id: str, status: str):
+        self.job_collection.update_one(
+            {"_id": job_id, "worker_id": worker_id},
+            {"$set": {"status": status, "worker_id": None, "lease_expires_at": None}},
+        )
+
+    def count_queued_jobs(self):
+        return self.job_collection.count_documents({"status": "queued"})
+
+    def get_active_user_jobs(self, user_id: int):
+        return list(self.job_collection.find({"user_id": user_id, "status": {"$in": ["queued", "running"]}}))
+
+    def cancel_user_jobs(self, user_id: int):
+        jobs = self.get_active_user_jobs(user_id)
+        self.job_collection.update_many(
+            {"_id": {"$in": [job["_id"] for job in jobs]}, "status": {"$in": ["queued", "running"]}},
+            {"$set": {"status": "cancelled"}},
+        )
+        return jobs
+
+    def get_file_id(self, key: str):
+        file_dict = self.file_collection.find_one({"_id": key})
+        return file_dict["file_id"] if file_dict is not None else None
+
+    def set_file_id(self, key: str, file_id: str):
+        self.file_collection.update_one(
+            {"_id": key},
+            {"$set": {"file_id": file_id, "last_sent_at": datetime.now()}, "$setOnInsert": {"created_at": datetime.now()}},
+            upsert=True,
+        )
+
+    def delete_file_id(self, key: str):
+        self.file_collection.delete_one({"_id": key})
+
+    def ensure_deck_indexes(self):
+        self.deck_collection.create_index("updated_at", expireAfterSeconds=config.deck_ttl_days * 24 * 60 * 60)
+
+    def ensure_rate_limit_indexes(self):
+        self.rate_limit_collection.create_index("expires_at", expireAfterSeconds=0)
+
+    def count_rate_limit_hit(self, key: str, window_start: int, window: int):
+        """Count a hit in the window of key starting at window_start, return the counts of it and of the one before."""
+        current = self.rate_limit_collection.find_one_and_update(
+            {"_id": f"{key}:{window_start}"},
+            {"$inc": {"count": 1},
+             "$setOnInsert": {"expires_at": datetime.now() + timedelta(seconds=2 * window)}},
+            upsert=True,
+            return_document=pymongo.ReturnDocument.AFTER,
+        )
+        previous = self.rate_limit_collection.find_one({"_id": f"{key}:{window_start - window}"})
+        return current["count"], previous["count"] if previous is not None else 0
+
+    def save_deck(self, deck_id: str, deck: dict):
+        # the images go in like a checkpoint's, decks too big to keep them have them fetched again
+        deck_dict = {"_id": deck_id, **encode_checkpoint(deck), "updated_at": datetime.now()}
+        self.deck_collection.replace_one({"_id": deck_id}, deck_dict, upsert=True)
+
+    def get_deck(self, deck_id: str, with_images: bool = True):
+        # the images are most of a deck, leave them out when only its outline is needed
+        projection = None if with_images else {"images": 0}
+        deck_dict = self.deck_collection.find_one({"_id": deck_id}, projection)
+        if deck_dict is not None and with_images:
+            deck_dict["images"] = decode_images(deck_dict.get("images", {}))
+        return deck_dict
+
+    def write_usage(self, batch_id: str, events: list, rollups: dict):
+        try:
+            self.usage_collection.insert_many(events, ordered=False)
+        except pymongo.errors.BulkWriteError as e:
+            # a retried batch may have been partly inserted by the attempt that failed
+            if any(error["code"] != 11000 for error in e.details["writeErrors"]):
+                raise
+        # a rollup already counting the batch doesn't match, its upsert then fails with a duplicate key instead
+        rollup_ids = list(rollups)
+        try:
+            self.usage_rollup_collection.bulk_write([
+                pymongo.UpdateOne(
+                    {"_id": rollup_id, "batches": {"$ne": batch_id}},
+                    self.rollup_update(batch_id, rollups[rollup_id]),
+                    upsert=True,
+                )
+                for rollup_id in rollup_ids
+            ], ordered=False)
+        except pymongo.errors.BulkWriteError as e:
+            if any(error["code"] != 11000 for error in e.details["writeErrors"]):
+                raise
+            for error in e.details["writeErrors"]:
+                rollup_id = rollup_ids[error["index"]]
+                if self.usage_rollup_collection.count_documents({"_id": rollup_id, "batches": batch_id}) > 0:
+                    continue
+                # another process inserted the rollup first, it exists now
+                self.usage_rollup_collection.update_one(
+                    {"_id": rollup_id, "batches": {"$ne": batch_id}},
+                    self.rollup_update(batch_id, rollups[rollup_id]),
+                )
+
+    @staticmethod
+    def rollup_update(batch_id: str, rollup: dict):
+        return {
+            "$setOnInsert": {"scope": rollup["scope"], "period": rollup["period"], "start": rollup["start"]},
+            "$inc": dict(rollup["increments"]),
+            "$push": {"batches": {"$each": [batch_id], "$slice": -ROLLUP_BATCH_IDS}},
+        }
+
+    def get_usage_rollups(self, rollup_ids: list):
+        return list(self.usage_rollup_collection.find({"_id": {"$in": rollup_ids}}, {"batches": 0}))
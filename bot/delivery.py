@@ -0,0 +1,105 @@
+import logging
+from collections import OrderedDict
+
+import ai_generator.output as output
+
+import telegram
+from telegram import InputMediaDocument
+
+import usage
+
+
+logger = logging.getLogger(__name__)
+
+MEMORY_CACHE_SIZE = 1024
+# the most documents Telegram accepts in one media group
+MEDIA_GROUP_SIZE = 10
+
+file_ids = OrderedDict()
+
+
+def remember(key, file_id):
+    file_ids[key] = file_id
+    file_ids.move_to_end(key)
+    if len(file_ids) > MEMORY_CACHE_SIZE:
+        file_ids.popitem(last=False)
+
+
+def lookup(db, key):
+    file_id = file_ids.get(key)
+    if file_id is None:
+        file_id = db.get_file_id(key)
+        if file_id is not None:
+            remember(key, file_id)
+    return file_id
+
+
+def forget(db, key):
+    file_ids.pop(key, None)
+    db.delete_file_id(key)
+
+
+async def send_document(bot, db, file, filename, chat_id, **kwargs):
+    """Send a generated document, reusing the file_id of an earlier upload of the same document."""
+    key = output.document_key(file, filename)
+    file_id = lookup(db, key)
+    if file_id is not None:
+        try:
+            message = await bot.send_document(chat_id=chat_id, document=file_id, **kwargs)
+            usage.add("documents")
+            usage.add("cache_hits")
+            return message
+        except telegram.error.BadRequest:
+            logger.warning(f"Cached file_id of {filename} was rejected, uploading it again")
+            forget(db, key)
+
+    file.seek(0)
+    message = await bot.send_document(chat_id=chat_id, document=file, filename=filename, **kwargs)
+    remember(key, message.document.file_id)
+    db.set_file_id(key, message.document.file_id)
+    usage.add("documents")
+    return message
+
+
+async def send_media_group(bot, db, documents, chat_id, **kwargs):
+    keys = [output.document_key(file, filename) for file, filename in documents]
+    cached_ids = [lookup(db, key) for key in keys]
+
+    def build_media(use_cache):
+        media = []
+        for (file, filename), file_id in zip(documents, cached_ids):
+            if use_cache and file_id is not None:
+                media.append(InputMediaDocument(file_id))
+            else:
+                file.seek(0)
+                media.append(InputMediaDocument(file, filename=filename))
+        return media
+
+    try:
+        messages = await bot.send_media_group(chat_id=chat_id, media=build_media(use_cache=True), **kwargs)
+        usage.add("cache_hits", sum(file_id is not None for file_id in cached_ids))
+    except telegram.error.BadRequest:
+        if all(file_id is None for file_id in cached_ids):
+            raise
+        logger.warning("Cached file_ids of a media group were rejected, uploading it again")
+        for key in keys:
+            forget(db, key)
+        messages = await bot.send_media_group(chat_id=chat_id, media=build_media(use_cache=False), **kwargs)
+    for key, message in zip(keys, messages):
+        remember(key, message.document.file_id)
+        db.set_file_id(key, message.document.file_id)
+    usage.add("documents", len(messages))
+    return messages
+
+
+async def send_documents(bot, db, documents, chat_id, **kwargs):
+    """Send (file, filename) pairs as few messages as possible: media groups of up to MEDIA_GROUP_SIZE documents."""
+    messages = []
+    for i in range(0, len(documents), MEDIA_GROUP_SIZE):
+        chunk = documents[i:i + MEDIA_GROUP_SIZE]
+        if len(chunk) == 1:
+            file, filename = chunk[0]
+            messages.append(await send_document(bot, db, file, filename, chat_id, **kwargs))
+        else:
+            messages.extend(await send_media_group(bot, db, chunk, chat_id, **kwargs))
+    return messages
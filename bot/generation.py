@@ -0,0 +1,335 @@
+import asyncio
+import contextlib
+import logging
+
+import ai_generator.abstract as abstract
+import ai_generator.image_scrapper.downloader as downloader
+import ai_generator.markup as markup
+import ai_generator.openai_utils as openai_utils
+import ai_generator.presentation as presentation
+import ai_generator.prompts as prompts
+
+import config
+
+import delivery
+
+import memory_budget
+
+import menu
+
+import metrics
+
+import progress
+
+import telegram
+
+import tracing
+
+import usage
+
+logger = logging.getLogger(__name__)
+
+
+async def charge_tokens(db, user_id, n_used_tokens):
+    available_tokens = db.get_user_attribute(user_id, "n_available_tokens")
+    db.set_user_attribute(user_id, "n_available_tokens", available_tokens - n_used_tokens)
+    used_tokens = db.get_user_attribute(user_id, "n_used_tokens")
+    db.set_user_attribute(user_id, "n_used_tokens", n_used_tokens + used_tokens)
+    usage.add("tokens", n_used_tokens)
+
+
+async def delete_status_message(bot, job):
+    progress.stop()
+    try:
+        await bot.delete_message(chat_id=job["chat_id"], message_id=job["status_message_id"])
+    except telegram.error.BadRequest:
+        pass
+
+
+async def report_failure(bot, job, text):
+    usage.set_status("failed")
+    await delete_status_message(bot, job)
+    await bot.send_message(chat_id=job["chat_id"], text=text, reply_to_message_id=job["message_id"])
+
+
+def report_slides_written(answer):
+    progress.report(f"✍️ Writing slides, {answer.count('[SLIDEBREAK]')} done…")
+
+
+@contextlib.contextmanager
+def image_pool(job, checkpoint):
+    # searching for the topic pays off while the completion is being written, so not for resumed jobs
+    if "answer" in checkpoint or not config.speculative_images or "topic" not in job:
+        yield None
+        return
+    pool = downloader.ImagePool(downloader.topic_queries(job["topic"], config.speculative_images),
+                                config.image_deadline)
+    try:
+        yield pool
+    finally:
+        pool.cancel()
+
+
+async def continue_completion(kind, prompt, size=None):
+    # the reply is delivered without what a failed continuation would have added
+    try:
+        response = await openai_utils.process_prompt(prompt, size=size)
+    except (OverflowError, RuntimeError, ValueError) as e:
+        logger.warning(f"Failed to fill in the reply of a {kind} job: {e}")
+        metrics.MARKUP_CONTINUATIONS.inc(kind=kind, result="failed")
+        return None, 0
+    metrics.MARKUP_CONTINUATIONS.inc(kind=kind, result="ok")
+    return response
+
+
+async def complete_presentation(job, answer):
+    """Repair the markup of a presentation reply and ask for the slides it is missing.
+
+    A reply cut off before its last slide is continued from the cut-off slide, and content slides left empty
+    are rewritten one by one, in at most markup_max_continuations completions.
+    """
+    report = markup.repair_presentation(answer)
+    slides = report.parsed
+    # jobs checkpointed by an older release lack the choices a continuation prompt needs
+    n_continuations = config.markup_max_continuations if "topic" in job else 0
+    n_used_tokens = 0
+    count = job.get("count")
+    if n_continuations and report.truncated and count and len(slides) < count:
+        n_continuations -= 1
+        progress.report("🩹 Writing the missing slides…")
+        written = slides[:-1]
+        prompt = await presentation.generate_continuation_prompt(job["language"], job["type"], job["topic"],
+                                                                 written, count)
+        response, n_tokens = await continue_completion("presentation", prompt, size=count - len(written))
+        n_used_tokens += n_tokens
+        continuation = markup.repair_presentation(response).parsed if response is not None else []
+        if continuation:
+            slides = written + continuation[:count - len(written)]
+    for i in markup.missing_content(slides)[:n_continuations]:
+        progress.report(f"🩹 Rewriting slide {i + 1}…")
+        prompt = await presentation.generate_slide_prompt(job["language"], job["type"], job["topic"], slides, i)
+        response, n_tokens = await continue_completion("presentation", prompt, size=1)
+        n_used_tokens += n_tokens
+        rewritten = markup.repair_presentation(response).parsed if response is not None else []
+        if rewritten and rewritten[0]["content"]:
+            slides[i] = rewritten[0]
+    return markup.format_slides(slides), n_used_tokens
+
+
+async def complete_abstract(job, answer):
+    """Repair the markup of an abstract reply and write the sections it has only a heading of."""
+    report = markup.repair_abstract(answer)
+    tags_array = report.parsed
+    title = next((text for tag, text in tags_array if tag == "TITLE"), job["topic"])
+    headings = [text for tag, text in tags_array if tag == "HEADING"]
+    sections = {}
+    n_used_tokens = 0
+    for i in report.missing[:config.markup_max_continuations]:
+        progress.report(f"🩹 Writing section {tags_array[i][1]}…")
+        prompt = await abstract.generate_docx_section_prompt(job["language"], job["type"], job["topic"], title,
+                                                             tags_array[i][1], headings)
+        response, n_tokens = await continue_completion("abstract", prompt)
+        n_used_tokens += n_tokens
+        section = markup.repair_abstract(response).parsed if response is not None else []
+        section = [item for item in section if item[0] in ("CONTENT", "IMAGE")]
+        if any(tag == "CONTENT" for tag, _ in section):
+            sections[i] = section
+    repaired = []
+    for i, item in enumerate(tags_array):
+        repaired.append(item)
+        repaired.extend(sections.get(i, []))
+    return markup.format_tags(repaired), n_used_tokens
+
+
+async def render_presentation_variants(job, answer, images, pool=None):
+    """Render one completion and one set of images into the job's template, its extra templates and an abstract."""
+    slides = await presentation.parse_slides(answer)
+    await presentation.fetch_images(slides, images, pool, config.image_deadline)
+    progress.report("🎨 Rendering slides…")
+    variants = job.get("variants", [])
+    templates = [job["template"]] + [variant for variant in variants if variant != menu.ABSTRACT_VARIANT]
+    # rendering holds the GIL, so rendering the variants side by side would only hold all their trees at once,
+    # they are rendered one after another on a thread that keeps the event loop free
+    documents = []
+    try:
+        for template in templates:
+            documents.append(await asyncio.to_thread(presentation.render_and_save, slides, images, template))
+        if menu.ABSTRACT_VARIANT in variants:
+            tags_array, docx_images = await abstract.tags_from_slides(slides, images)
+            documents.append(await asyncio.to_thread(abstract.render_and_save, tags_array, docx_images))
+    except BaseException:
+        for file, _ in documents:
+            file.close()
+        raise
+    # every deck has the same title, so the extra templates are told apart by their file name
+    for i, template in enumerate(templates[1:], 1):
+        file, title = documents[i]
+        documents[i] = (file, f"{title[:-len('.pptx')]} ({template}).pptx")
+    return documents
+
+
+async def generate_presentation(bot, db, job):
+    # results of finished stages are kept in the checkpoint so that a job resumed after a restart skips them
+    checkpoint = job.setdefault("checkpoint", {})
+    with image_pool(job, checkpoint) as pool:
+        if "answer" not in checkpoint:
+            try:
+                response, n_used_tokens = await openai_utils.process_prompt(
+                    job["prompt"], on_progress=report_slides_written, system=job.get("system_prompt"),
+                    variant=job.get("prompt_variant"), size=job.get("count"))
+            except OverflowError:
+                await report_failure(bot, job, "System is currently overloaded. Please try again. 😊")
+                return
+            except RuntimeError:
+                await report_failure(bot, job, "Some error happened. Please try again. 😊")
+                return
+            except ValueError:
+                await report_failure(bot, job, "Your Presentation is too big. Please try again😊")
+                return
+            if "prompt_variant" in job:
+                await prompts.check_reply(job["prompt_variant"], response)
+            response, n_continuation_tokens = await complete_presentation(job, response)
+            await charge_tokens(db, job["user_id"], n_used_tokens + n_continuation_tokens)
+            checkpoint["answer"] = response
+        images = checkpoint.setdefault("images", {})
+        documents = await render_presentation_variants(job, checkpoint["answer"], images, pool)
+    # jobs checkpointed by an older release lack the choices a slide prompt needs
+    deck_id = job["id"] if "topic" in job else None
+    await deliver_presentation(bot, db, job, documents, deck_id)
+    if deck_id is not None:
+        await save_deck(db, deck_id, job, checkpoint["answer"], images)
+
+
+async def regenerate_slide(bot, db, job):
+    deck = db.get_deck(job["deck_id"])
+    if deck is None:
+        await report_failure(bot, job, "This Presentation can no longer be changed. Please create a new one😊")
+        return
+    checkpoint = job.setdefault("checkpoint", {})
+    if "answer" not in checkpoint:
+        slides = await presentation.parse_slides(deck["answer"])
+        prompt = await presentation.generate_slide_prompt(deck["language"], deck["type"], deck["topic"], slides,
+                                                          job["slide"])
+        try:
+            response, n_used_tokens = await openai_utils.process_prompt(prompt, size=1)
+        except OverflowError:
+            await report_failure(bot, job, "System is currently overloaded. Please try again. 😊")
+            return
+        except (RuntimeError, ValueError):
+            await report_failure(bot, job, "Some error happened. Please try again. 😊")
+            return
+        await charge_tokens(db, job["user_id"], n_used_tokens)
+        rewritten = markup.repair_presentation(response)
+        if not rewritten.parsed:
+            await report_failure(bot, job, "Some error happened. Please try again. 😊")
+            return
+        checkpoint["answer"] = await presentation.replace_slide(deck["answer"], job["slide"], rewritten.reply)
+        # every other slide keeps its image, the regenerated one gets an image for its new keywords
+        checkpoint["images"] = {i: image for i, image in deck["images"].items() if i != job["slide"]}
+    images = checkpoint.setdefault("images", {})
+    documents = await render_presentation_variants(deck, checkpoint["answer"], images)
+    await deliver_presentation(bot, db, job, documents, job["deck_id"])
+    await save_deck(db, job["deck_id"], deck, checkpoint["answer"], images)
+
+
+async def deliver_presentation(bot, db, job, documents, deck_id):
+    progress.report("📤 Uploading…")
+    kwargs = {"reply_to_message_id": job["message_id"]}
+    # a media group can't carry a keyboard, so the regenerate button of several files gets its own message
+    if deck_id is not None and len(documents) == 1:
+        kwargs["reply_markup"] = menu.build_regenerate_keyboard(deck_id)
+    with contextlib.ExitStack() as stack:
+        for file, _ in documents:
+            stack.enter_context(file)
+        with tracing.span("upload"), metrics.STAGE_SECONDS.time(stage="upload"):
+            messages = await delivery.send_documents(bot, db, documents, job["chat_id"], **kwargs)
+    if deck_id is not None and len(documents) > 1:
+        await bot.send_message(chat_id=job["chat_id"], text="Something wrong with a slide?",
+                               reply_to_message_id=messages[0].message_id,
+                               reply_markup=menu.build_regenerate_keyboard(deck_id))
+    await delete_status_message(bot, job)
+
+
+async def save_deck(db, deck_id, job, answer, images):
+    deck = {key: job[key] for key in ("user_id", "template", "variants", "language", "type", "topic")}
+    deck.update(answer=answer, images=images)
+    await asyncio.to_thread(db.save_deck, deck_id, deck)
+
+
+async def generate_abstract(bot, db, job):
+    checkpoint = job.setdefault("checkpoint", {})
+    with image_pool(job, checkpoint) as pool:
+        if "answer" not in checkpoint:
+            try:
+                if config.abstract_mode == "outline":
+                    outline_prompt = await abstract.generate_docx_outline_prompt(job["language"], job["type"],
+                                                                                 job["topic"])
+                    outline, n_outline_tokens = await openai_utils.process_prompt(outline_prompt)
+                    try:
+                        response, n_used_tokens = await abstract.expand_outline(
+                            outline, job["language"], job["type"], job["topic"], openai_utils.process_prompt,
+                            config.abstract_max_concurrency)
+                    except Exception:
+                        # the outline was completed even though none of its sections were
+                        await charge_tokens(db, job["user_id"], n_outline_tokens)
+                        raise
+                    n_used_tokens += n_outline_tokens
+                else:
+                    response, n_used_tokens = await openai_utils.process_prompt(
+                        job["prompt"], system=job.get("system_prompt"), variant=job.get("prompt_variant"))
+                    if "prompt_variant" in job:
+                        await prompts.check_reply(job["prompt_variant"], response)
+            except OverflowError:
+                await report_failure(bot, job, "System is currently overloaded. Please try again😊")
+                return
+            except RuntimeError:
+                await report_failure(bot, job, "Some error happened. Please try again😊")
+                return
+            except ValueError:
+                await report_failure(bot, job, "Your Abstract is too big. Please try again😊")
+                return
+            response, n_continuation_tokens = await complete_abstract(job, response)
+            await charge_tokens(db, job["user_id"], n_used_tokens + n_continuation_tokens)
+            checkpoint["answer"] = response
+        images = checkpoint.setdefault("images", {})
+        docx_file, docx_title = await abstract.generate_docx(checkpoint["answer"], images, pool, config.image_deadline)
+    progress.report("📤 Uploading…")
+    with docx_file, tracing.span("upload"), metrics.STAGE_SECONDS.time(stage="upload"):
+        await delivery.send_document(bot, db, docx_file, docx_title, job["chat_id"],
+                                     reply_to_message_id=job["message_id"])
+    await delete_status_message(bot, job)
+
+
+GENERATORS = {
+    "presentation": generate_presentation,
+    "abstract": generate_abstract,
+    "slide": regenerate_slide,
+}
+
+
+async def run_job(bot, db, job):
+    metrics.JOBS_IN_FLIGHT.inc()
+    try:
+        with usage.recording(job), \
+                progress.reporting(bot, job["chat_id"], job["status_message_id"], config.progress_interval):
+            async with memory_budget.budget.admit(job, on_wait=lambda: progress.report("⌛ Waiting for memory…")):
+                with tracing.profiler.profile(job, config.profile_dir), \
+                        tracing.trace(job["id"], config.trace_path, kind=job["kind"], user_id=job["user_id"]), \
+                        metrics.STAGE_SECONDS.time(stage="job"):
+                    if "answer" not in job.get("checkpoint", {}):
+                        progress.report("✍️ Writing text…")
+                    await GENERATORS[job["kind"]](bot, db, job)
+    except asyncio.CancelledError:
+        if not job.get("checkpointed"):
+            await delete_status_message(bot, job)
+        raise
+    except Exception as e:
+        metrics.ERRORS.inc(type=type(e).__name__)
+        # the generators report the errors they expect, the user still hears about any other one
+        try:
+            await report_failure(bot, job, "Some error happened. Please try again. 😊")
+        except telegram.error.TelegramError as report_error:
+            logger.warning(f"Could not report the failure of job {job['id']}: {report_error}")
+        raise
+    finally:
+        metrics.JOBS_IN_FLIGHT.dec()
@@ -0,0 +1,23 @@
+import aiohttp
+
+
+# one connection pool for image search, image downloads and OpenAI instead of a new session per request
+MAX_CONNECTIONS = 100
+DNS_CACHE_SECONDS = 300
+
+session = None
+
+
+def get_session():
+    global session
+    if session is None or session.closed:
+        connector = aiohttp.TCPConnector(limit=MAX_CONNECTIONS, ttl_dns_cache=DNS_CACHE_SECONDS)
+        session = aiohttp.ClientSession(connector=connector)
+    return session
+
+
+async def close():
+    global session
+    if session is not None:
+        await session.close()
+        session = None
@@ -0,0 +1,211 @@
+import asyncio
+import collections
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+
+class QueueFullError(Exception):
+    pass
+
+
+class UserJobLimitError(Exception):
+    pass
+
+
+class GenerationQueue:
+    """Runs jobs on n_workers tasks.
+
+    Jobs are admitted one at a time in the order they were submitted, e.g. into the memory budget, and only
+    an admitted job takes a worker, so a job waiting for memory doesn't hold one.
+    """
+
+    def __init__(self, n_workers, max_size, max_jobs_per_user):
+        self.n_workers = n_workers
+        self.max_size = max_size
+        self.max_jobs_per_user = max_jobs_per_user
+
+        self.pending = collections.deque()
+        self.admitting = None
+        self.ready = collections.deque()
+        self.running = {}
+        self.workers = []
+        self.closed = False
+        self._submitted = asyncio.Semaphore(0)
+        self._available = asyncio.Semaphore(0)
+        self._run_job = None
+        self._checkpoint_job = None
+        self._admit = None
+        self._release = None
+
+    def start(self, run_job, checkpoint_job, admit=None, release=None):
+        self._run_job = run_job
+        self._checkpoint_job = checkpoint_job
+        self._admit = admit
+        self._release = release
+        self.workers = [asyncio.create_task(self._admit_jobs())]
+        self.workers += [asyncio.create_task(self._work()) for _ in range(self.n_workers)]
+
+    async def stop(self):
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+        for job in self.ready:
+            self._release_job(job)
+
+    async def drain(self, timeout):
+        """Stop taking jobs, give running ones timeout seconds to finish and checkpoint the rest."""
+        self.closed = True
+        running_tasks = [task for _, task in self.running.values()]
+        if running_tasks:
+            logger.info(f"Waiting up to {timeout} s for {len(running_tasks)} running jobs")
+            await asyncio.wait(running_tasks, timeout=timeout)
+        unfinished_jobs = [*self.queued_jobs(), *(job for job, _ in self.running.values())]
+        for job in unfinished_jobs:
+            job["checkpointed"] = True
+        await self.stop()
+        self.pending.clear()
+        self.ready.clear()
+        for job in unfinished_jobs:
+            self._checkpoint_job(job)
+        if unfinished_jobs:
+            logger.info(f"Checkpointed {len(unfinished_jobs)} unfinished jobs")
+
+    def resume(self, job):
+        # resumed jobs were accepted before the restart, so they skip the queue and per-user limits of submit(),
+        # they still wait for their turn in admission like any other job
+        self.pending.append(job)
+        self._submitted.release()
+
+    def queued_jobs(self):
+        admitting_jobs = [self.admitting[0]] if self.admitting is not None else []
+        return [*self.ready, *admitting_jobs, *self.pending]
+
+    def user_jobs(self, user_id):
+        running_jobs = [job for job, _ in self.running.values()]
+        return [job for job in [*self.queued_jobs(), *running_jobs] if job["user_id"] == user_id]
+
+    def check_admission(self, user_id):
+        if self.closed or self.depth() >= self.max_size:
+            raise QueueFullError(f"Generation queue is full ({self.max_size} jobs)")
+        if len(self.user_jobs(user_id)) >= self.max_jobs_per_user:
+            raise UserJobLimitError(f"User {user_id} already has {self.max_jobs_per_user} active jobs")
+
+    def position(self):
+        # position a newly submitted job would get, 0 when a worker would pick it up right away
+        idle_workers = self.n_workers - len(self.running)
+        return max(0, self.depth() + 1 - idle_workers)
+
+    def depth(self):
+        return len(self.queued_jobs())
+
+    def submit(self, job):
+        self.check_admission(job["user_id"])
+        self.pending.append(job)
+        self._submitted.release()
+
+    def cancel_user_jobs(self, user_id):
+        cancelled_jobs = []
+        for job in [job for job in self.pending if job["user_id"] == user_id]:
+            self.pending.remove(job)
+            cancelled_jobs.append(job)
+        for job in [job for job in self.ready if job["user_id"] == user_id]:
+            self.ready.remove(job)
+            self._release_job(job)
+            cancelled_jobs.append(job)
+        if self.admitting is not None and self.admitting[0]["user_id"] == user_id:
+            job, task = self.admitting
+            task.cancel()
+            cancelled_jobs.append(job)
+        for job, task in self.running.values():
+            if job["user_id"] == user_id:
+                task.cancel()
+                cancelled_jobs.append(job)
+        return cancelled_jobs
+
+    def _release_job(self, job):
+        if self._release is not None:
+            self._release(job)
+
+    async def _admit_jobs(self):
+        while True:
+            await self._submitted.acquire()
+            if self.closed or not self.pending:
+                # the job this was released for has been cancelled while waiting
+                continue
+            job = self.pending.popleft()
+            if self._admit is not None:
+                task = asyncio.create_task(self._admit(job))
+                self.admitting = (job, task)
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    if asyncio.current_task().cancelling():
+                        raise
+                    logger.info(f"Job {job['id']} was cancelled")
+                    continue
+                finally:
+                    self.admitting = None
+            self.ready.append(job)
+            self._available.release()
+
+    async def _work(self):
+        while True:
+            await self._available.acquire()
+            if self.closed or not self.ready:
+                # the job this slot was released for has been cancelled while waiting
+                continue
+            job = self.ready.popleft()
+            task = asyncio.create_task(self._run_job(job))
+            self.running[job["id"]] = (job, task)
+            try:
+                await task
+            except asyncio.CancelledError:
+                if asyncio.current_task().cancelling():
+                    raise
+                logger.info(f"Job {job['id']} was cancelled")
+            except Exception:
+                logger.exception(f"Job {job['id']} failed")
+            finally:
+                del self.running[job["id"]]
+
+
+class MongoGenerationQueue:
+    """Hands jobs over to the worker processes (bot/worker.py) through the job collection."""
+
+    def __init__(self, db, max_size, max_jobs_per_user):
+        self.db = db
+        self.max_size = max_size
+        self.max_jobs_per_user = max_jobs_per_user
+
+    def start(self, run_job, checkpoint_job, admit=None, release=None):
+        pass
+
+    async def stop(self):
+        pass
+
+    async def drain(self, timeout):
+        # jobs run in the worker processes, which drain themselves
+        pass
+
+    def check_admission(self, user_id):
+        if self.db.count_queued_jobs() >= self.max_size:
+            raise QueueFullError(f"Generation queue is full ({self.max_size} jobs)")
+        if len(self.db.get_active_user_jobs(user_id)) >= self.max_jobs_per_user:
+            raise UserJobLimitError(f"User {user_id} already has {self.max_jobs_per_user} active jobs")
+
+    def position(self):
+        n_queued_jobs = self.db.count_queued_jobs()
+        return n_queued_jobs + 1 if n_queued_jobs > 0 else 0
+
+    def depth(self):
+        return self.db.count_queued_jobs()
+
+    def submit(self, job):
+        self.check_admission(job["user_id"])
+        self.db.enqueue_job(job)
+
+    def cancel_user_jobs(self, user_id):
+        return self.db.cancel_user_jobs(user_id)
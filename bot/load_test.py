@@ -0,0 +1,360 @@
+import argparse
+import asyncio
+import contextlib
+import itertools
+import json
+import logging
+import platform
+import random
+import re
+import resource
+import statistics
+import sys
+import time
+from pathlib import Path
+
+from aiohttp import web
+
+import ai_generator.image_scrapper.bing as bing
+
+import benchmark
+
+import config
+
+import menu
+
+import openai
+
+
+logger = logging.getLogger(__name__)
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "Load test bot", "username": "load_test_bot"}
+FIRST_USER_ID = 1_000_000
+FAILURE_TEXTS = ("Please try again", "not enough tokens", "Please wait until")
+# share of presentations that also ask for one more template or an abstract
+VARIANT_SHARE = 0.25
+
+
+class FakeBotApi:
+    """Answers the Bot API methods the bot uses and hands its messages to the simulated users."""
+
+    def __init__(self):
+        self.updates = []
+        self.new_updates = asyncio.Condition()
+        self.update_ids = itertools.count(1)
+        self.message_ids = itertools.count(1)
+        self.inboxes = {}
+
+    def inbox(self, chat_id):
+        return self.inboxes.setdefault(chat_id, asyncio.Queue())
+
+    async def push_update(self, update):
+        update["update_id"] = next(self.update_ids)
+        async with self.new_updates:
+            self.updates.append(update)
+            self.new_updates.notify_all()
+
+    async def get_updates(self, params):
+        offset = int(params.get("offset", 0))
+        async with self.new_updates:
+            self.updates = [update for update in self.updates if update["update_id"] >= offset]
+            if not self.updates:
+                with contextlib.suppress(asyncio.TimeoutError):
+                    await asyncio.wait_for(self.new_updates.wait(), float(params.get("timeout", 0)))
+            return self.updates[:int(params.get("limit", 100))]
+
+    def message(self, params, **fields):
+        message = {
+            "message_id": int(params.get("message_id") or next(self.message_ids)),
+            "date": int(time.time()),
+            "chat": {"id": int(params["chat_id"]), "type": "private"},
+            "from": BOT_USER,
+            **fields,
+        }
+        if "reply_markup" in params:
+            message["reply_markup"] = json.loads(params["reply_markup"])
+        return message
+
+    def document(self, params, document):
+        # files of a media group are attached as separate fields
+        if isinstance(document, str) and document.startswith("attach://"):
+            document = params[document[len("attach://"):]]
+        return {
+            "file_id": document if isinstance(document, str) else f"file-{next(self.message_ids)}",
+            "file_unique_id": "unique",
+            "file_size": len(document),
+        }
+
+    async def handle(self, request):
+        method = request.match_info["method"]
+        params = {}
+        for name, value in (await request.post()).items():
+            params[name] = value if isinstance(value, str) else value.file.read()
+
+        match method:
+            case "getMe":
+                result = BOT_USER
+            case "getUpdates":
+                result = await self.get_updates(params)
+            case "sendMessage" | "editMessageText":
+                result = self.message(params, text=params["text"])
+            case "sendDocument":
+                result = self.message(params, document=self.document(params, params["document"]))
+            case "sendMediaGroup":
+                result = [self.message(params, document=self.document(params, media["media"]))
+                          for media in json.loads(params["media"])]
+            case _:
+                result = True
+
+        if method in ("sendMessage", "editMessageText", "sendDocument"):
+            self.inbox(int(params["chat_id"])).put_nowait((method, result))
+        elif method == "sendMediaGroup":
+            for message in result:
+                self.inbox(int(params["chat_id"])).put_nowait(("sendDocument", message))
+        return web.json_response({"ok": True, "result": result})
+
+
+def fake_completion(prompt):
+    # the original prompts spell the choices out in sentences, the compact ones list them line by line
+    match = re.search(r"which is (\d+) slides long|^Slides: (\d+)$", prompt, re.MULTILINE)
+    if match is None:
+        return benchmark.synthetic_abstract_reply(5)
+    topic = re.search(r"on the topic of (.*) which is|^Topic: (.*)$", prompt, re.MULTILINE)
+    topic = topic.group(1) or topic.group(2)
+    # a distinct title per topic keeps decks from being served by the file_id cache
+    n_slides = int(match.group(1) or match.group(2))
+    return benchmark.synthetic_presentation_reply(n_slides).replace("Mount Everest The Highest", topic, 1)
+
+
+def build_openai_app(latency, jitter):
+    async def completions_handle(request):
+        body = await request.json()
+        reply = fake_completion(body["messages"][-1]["content"])
+        await asyncio.sleep(max(0.0, random.gauss(latency, jitter)))
+        if not body.get("stream"):
+            return web.json_response({
+                "object": "chat.completion",
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": reply}, "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": 500, "completion_tokens": len(reply) // 4,
+                          "total_tokens": 500 + len(reply) // 4},
+            })
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        for i in range(0, len(reply), 16):
+            chunk = {"object": "chat.completion.chunk", "choices": [{"index": 0, "delta": {"content": reply[i:i + 16]}}]}
+            await response.write(f"data: {json.dumps(chunk)}\n\n".encode())
+        await response.write(b"data: [DONE]\n\n")
+        return response
+
+    web_app = web.Application()
+    web_app.router.add_post("/v1/chat/completions", completions_handle)
+    return web_app
+
+
+def build_images_app(latency):
+    images = benchmark.load_fixture_images()
+
+    async def search_handle(request):
+        await asyncio.sleep(latency)
+        link = f"http://{request.host}/images/{random.randrange(len(images))}"
+        return web.Response(text=f"<a m=\"{{murl&quot;:&quot;{link}&quot;}}\"></a>")
+
+    async def image_handle(request):
+        await asyncio.sleep(latency)
+        return web.Response(body=images[int(request.match_info["index"])])
+
+    web_app = web.Application()
+    web_app.router.add_get("/images/async", search_handle)
+    web_app.router.add_get("/images/{index}", image_handle)
+    return web_app
+
+
+async def start_site(web_app, port):
+    runner = web.AppRunner(web_app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", port)
+    await site.start()
+    return runner, site._server.sockets[0].getsockname()[1]
+
+
+class SimulatedUser:
+    def __init__(self, api, user_id, rng):
+        self.api = api
+        self.user = {"id": user_id, "is_bot": False, "first_name": "Load", "username": f"load_test_{user_id}"}
+        self.chat = {"id": user_id, "type": "private"}
+        self.inbox = api.inbox(user_id)
+        self.rng = rng
+        self.message_ids = itertools.count(1_000_000)
+
+    async def send_text(self, text):
+        message = {"message_id": next(self.message_ids), "date": int(time.time()), "chat": self.chat,
+                   "from": self.user, "text": text}
+        if text.startswith("/"):
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        await self.api.push_update({"message": message})
+
+    async def click(self, message, data):
+        await self.api.push_update({"callback_query": {
+            "id": str(next(self.message_ids)), "from": self.user, "chat_instance": str(self.chat["id"]),
+            "message": message, "data": data,
+        }})
+
+    async def receive(self, method=None, message_id=None):
+        # progress edits of an earlier job may still arrive, anything not asked for is skipped
+        while True:
+            received_method, message = await self.inbox.get()
+            if any(text in message.get("text", "") for text in FAILURE_TEXTS):
+                raise RuntimeError(message["text"])
+            if method in (None, received_method) and message_id in (None, message["message_id"]):
+                return message
+
+    def pick_option(self, message):
+        # option buttons carry a value, paging and back buttons don't
+        buttons = [button for row in message["reply_markup"]["inline_keyboard"] for button in row
+                   if button["callback_data"].count("|") == 3 and button["callback_data"].split("|")[2]]
+        done = [button for button in buttons if int(button["callback_data"].split("|")[2]) == menu.DONE]
+        if done:
+            # a multi-select step: pick at most one extra variant, then press Done
+            buttons = [button for button in buttons if button not in done]
+            if any(button["text"].startswith("✅") for button in buttons) or self.rng.random() >= VARIANT_SHARE:
+                return done[0]["callback_data"]
+        return self.rng.choice(buttons)["callback_data"]
+
+    async def generate_presentation(self, topic):
+        await self.send_text("/menu")
+        message = await self.receive("sendMessage")
+        await self.click(message, menu.callback_data(menu.PRESENTATION, 0, page=1))
+        while True:
+            message = await self.receive("editMessageText", message["message_id"])
+            if "reply_markup" not in message:
+                break
+            await self.click(message, self.pick_option(message))
+
+        started = time.perf_counter()
+        await self.send_text(topic)
+        await self.receive("sendDocument")
+        return time.perf_counter() - started
+
+
+async def monitor_loop_lag(samples, interval=0.05):
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(interval)
+        samples.append(loop.time() - started - interval)
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q / 100 * len(values)))]
+
+
+async def run_load_test(n_users, jobs_per_user, ramp_up, job_timeout, llm_latency, llm_jitter, image_latency, seed):
+    api = FakeBotApi()
+    # generated documents are bigger than the 1 MB aiohttp accepts by default
+    api_app = web.Application(client_max_size=100 * 1024 * 1024)
+    api_app.router.add_post("/bot{token}/{method}", api.handle)
+    api_runner, api_port = await start_site(api_app, 0)
+    openai_runner, openai_port = await start_site(build_openai_app(llm_latency, llm_jitter), 0)
+    images_runner, images_port = await start_site(build_images_app(image_latency), 0)
+
+    config.telegram_api_url = f"http://127.0.0.1:{api_port}/bot"
+    config.allowed_telegram_usernames = []
+    openai.api_base = f"http://127.0.0.1:{openai_port}/v1"
+    bing.SEARCH_URL = f"http://127.0.0.1:{images_port}/images/async"
+
+    # imported here because it connects to Mongo and builds its job queue on import
+    import bot as bot_module
+
+    application = bot_module.build_application()
+    lag_samples = []
+    latencies = []
+    failures = []
+
+    async def drive(index):
+        await asyncio.sleep(ramp_up * index / n_users)
+        user = SimulatedUser(api, FIRST_USER_ID + index, random.Random(seed + index))
+        for job in range(jobs_per_user):
+            try:
+                latencies.append(await asyncio.wait_for(
+                    user.generate_presentation(f"Load test topic {index}-{job}"), job_timeout))
+            except Exception as e:
+                failures.append(f"{type(e).__name__}: {e}")
+
+    async with application:
+        await application.post_init(application)
+        await application.updater.start_polling(poll_interval=0, timeout=1)
+        await application.start()
+        lag_monitor = asyncio.create_task(monitor_loop_lag(lag_samples))
+        started = time.perf_counter()
+        try:
+            await asyncio.gather(*(drive(i) for i in range(n_users)))
+        finally:
+            elapsed = time.perf_counter() - started
+            lag_monitor.cancel()
+            await application.updater.stop()
+            await application.stop()
+            await application.post_stop(application)
+    await application.post_shutdown(application)
+    for runner in (api_runner, openai_runner, images_runner):
+        await runner.cleanup()
+
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "users": n_users,
+        "jobs_per_user": jobs_per_user,
+        "generation_workers": config.generation_workers,
+        "llm_latency_s": llm_latency,
+        "image_latency_s": image_latency,
+        "elapsed_s": elapsed,
+        "completed_jobs": len(latencies),
+        "failed_jobs": len(failures),
+        "failures": sorted(set(failures)),
+        "jobs_per_minute": len(latencies) / elapsed * 60,
+        "latency_s": {
+            "p50": percentile(latencies, 50),
+            "p95": percentile(latencies, 95),
+            "p99": percentile(latencies, 99),
+            "max": max(latencies, default=None),
+        },
+        "event_loop_lag_s": {
+            "mean": statistics.mean(lag_samples) if lag_samples else None,
+            "p99": percentile(lag_samples, 99),
+            "max": max(lag_samples, default=None),
+        },
+        # ru_maxrss is in kilobytes on Linux, fake services run in the same process and are included
+        "peak_rss_bytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end load test against fake Telegram, OpenAI and image services")
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--jobs-per-user", type=int, default=1)
+    parser.add_argument("--ramp-up", type=float, default=5, help="seconds over which the users start")
+    parser.add_argument("--job-timeout", type=float, default=600)
+    parser.add_argument("--llm-latency", type=float, default=10, help="mean seconds a fake completion takes")
+    parser.add_argument("--llm-jitter", type=float, default=2)
+    parser.add_argument("--image-latency", type=float, default=0.2, help="seconds a fake image search or download takes")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--mongodb-uri", default=config.mongodb_uri, help="Mongo the bot under test stores users in")
+    parser.add_argument("--output", help="path of the JSON report, printed to stdout if omitted")
+    args = parser.parse_args()
+
+    config.mongodb_uri = args.mongodb_uri
+    logging.basicConfig(level=logging.WARNING, stream=sys.stderr)
+    with contextlib.redirect_stdout(sys.stderr):
+        report = asyncio.run(run_load_test(args.users, args.jobs_per_user, args.ramp_up, args.job_timeout,
+                                           args.llm_latency, args.llm_jitter, args.image_latency, args.seed))
+    report_json = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        Path(args.output).write_text(report_json)
+    else:
+        sys.stdout.write(report_json + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,197 @@
+import asyncio
+import collections
+import contextlib
+import logging
+import os
+import random
+import tracemalloc
+
+import ai_generator.output as output
+import ai_generator.presentation as presentation
+
+import config
+
+import menu
+
+import metrics
+
+
+logger = logging.getLogger(__name__)
+
+# peak of a job apart from its templates and images: the completion, parsed slides and python-pptx objects
+BASE_BYTES = 32 * 1024 * 1024
+# a template is unzipped and parsed into lxml trees several times the size of its .pptx
+TEMPLATE_FACTOR = 8
+# a downloaded image is held in the checkpoint, in the rendered document and in the saved file
+IMAGE_FACTOR = 3
+ABSTRACT_IMAGES = 12
+DEFAULT_SLIDES = 12
+# measurements nudge an estimate towards them instead of replacing it
+SMOOTHING = 0.8
+MIN_CORRECTION = 0.25
+MAX_CORRECTION = 4
+RSS_SAMPLE_INTERVAL = 0.1
+
+
+def current_rss():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return 0
+
+
+class MemoryBudget:
+    """Admits generation jobs while the sum of their estimated peak memory stays under ceiling bytes.
+
+    Estimates come from the slide count, the templates and max_image_bytes, scaled by a correction per
+    job kind that is learned from the measured peak of a sample_rate share of the jobs. Jobs are admitted
+    in the order they asked, so a big job isn't overtaken by smaller ones for as long as they keep coming.
+    """
+
+    def __init__(self, ceiling, max_image_bytes, sample_rate, speculative_images):
+        self.ceiling = ceiling
+        self.max_image_bytes = max_image_bytes
+        self.sample_rate = sample_rate
+        self.speculative_images = speculative_images
+
+        self.reserved = {}
+        self.corrections = {}
+        self._waiters = collections.deque()
+        self._measuring = False
+        self._window_reserved = 0
+
+    def raw_estimate(self, job):
+        # mirrors generation.image_pool: the topic's images are searched for while a new completion is written
+        pool_bytes = 0
+        if "topic" in job and "answer" not in job.get("checkpoint", {}):
+            pool_bytes = self.speculative_images * self.max_image_bytes
+        if job["kind"] == "abstract":
+            return BASE_BYTES + pool_bytes + ABSTRACT_IMAGES * self.max_image_bytes * IMAGE_FACTOR
+        variants = job.get("variants", [])
+        templates = [job["template"]] + [variant for variant in variants if variant != menu.ABSTRACT_VARIANT]
+        n_images = job.get("count", DEFAULT_SLIDES)
+        # the templates are rendered one at a time, the saved files are held until they are delivered
+        template_bytes = max(presentation.template_size(template) for template in templates) * TEMPLATE_FACTOR
+        saved_bytes = len(templates) * output.SPOOL_MAX_SIZE
+        image_bytes = n_images * self.max_image_bytes * IMAGE_FACTOR
+        if menu.ABSTRACT_VARIANT in variants:
+            # the abstract embeds its own copy of the images
+            image_bytes += n_images * self.max_image_bytes
+            saved_bytes += output.SPOOL_MAX_SIZE
+        return BASE_BYTES + pool_bytes + template_bytes + saved_bytes + image_bytes
+
+    def estimate(self, job):
+        return int(self.raw_estimate(job) * self.corrections.get(job["kind"], 1))
+
+    def total_reserved(self):
+        return sum(self.reserved.values())
+
+    def fits(self, size):
+        # a job bigger than the whole budget still runs, alone
+        return not self.reserved or self.total_reserved() + size <= self.ceiling
+
+    def learn(self, kind, observed, raw_estimate):
+        correction = min(MAX_CORRECTION, max(MIN_CORRECTION, observed / raw_estimate))
+        previous = self.corrections.get(kind, 1)
+        self.corrections[kind] = SMOOTHING * previous + (1 - SMOOTHING) * correction
+        logger.info(f"Measured {observed:.0f} bytes for a {kind} job estimated at {raw_estimate * previous:.0f}, "
+                    f"correction is now {self.corrections[kind]:.2f}")
+
+    def reserve(self, job_id, size):
+        self.reserved[job_id] = size
+        self._window_reserved = max(self._window_reserved, self.total_reserved())
+
+    def _admit_waiters(self):
+        while self._waiters:
+            future, job_id, size = self._waiters[0]
+            if future.done():
+                # its job was cancelled while waiting
+                self._waiters.popleft()
+                continue
+            if not self.fits(size):
+                break
+            self._waiters.popleft()
+            self.reserve(job_id, size)
+            future.set_result(None)
+
+    async def acquire(self, job, on_wait=None):
+        """Wait for the job's turn and for its estimate to fit in the budget, then reserve it."""
+        if not self.ceiling or job["id"] in self.reserved:
+            return
+        size = self.estimate(job)
+        if not self._waiters and self.fits(size):
+            self.reserve(job["id"], size)
+            return
+
+        if on_wait is not None:
+            on_wait()
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.append((future, job["id"], size))
+        try:
+            await future
+        except asyncio.CancelledError:
+            # cancelled right after its reservation was made
+            if future.done() and not future.cancelled():
+                self.release(job)
+            raise
+        finally:
+            self._admit_waiters()
+
+    def release(self, job):
+        if self.reserved.pop(job["id"], None) is not None:
+            self._admit_waiters()
+
+    @contextlib.asynccontextmanager
+    async def admit(self, job, on_wait=None):
+        """Reserve the job's estimate, unless it was reserved before, and hold it while the job runs."""
+        if not self.ceiling:
+            yield
+            return
+
+        await self.acquire(job, on_wait)
+        try:
+            if not self._measuring and random.random() < self.sample_rate:
+                async with self.measure(job, self.reserved[job["id"]]):
+                    yield
+            else:
+                yield
+        finally:
+            self.release(job)
+
+    @contextlib.asynccontextmanager
+    async def measure(self, job, size):
+        # tracemalloc misses what lxml and Pillow allocate in C, so the RSS growth is sampled alongside it
+        self._measuring = True
+        self._window_reserved = self.total_reserved()
+        started_tracing = not tracemalloc.is_tracing()
+        if started_tracing:
+            tracemalloc.start()
+        traced_start = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        rss_start = rss_peak = current_rss()
+
+        async def sample_rss():
+            nonlocal rss_peak
+            while True:
+                await asyncio.sleep(RSS_SAMPLE_INTERVAL)
+                rss_peak = max(rss_peak, current_rss())
+
+        sampler = asyncio.create_task(sample_rss())
+        try:
+            yield
+        finally:
+            sampler.cancel()
+            traced_growth = tracemalloc.get_traced_memory()[1] - traced_start
+            if started_tracing:
+                tracemalloc.stop()
+            self._measuring = False
+        # jobs running alongside grow memory too, so the growth is split by the share of the estimates
+        growth = max(traced_growth, max(rss_peak, current_rss()) - rss_start)
+        observed = growth * size / max(size, self._window_reserved)
+        self.learn(job["kind"], observed, self.raw_estimate(job))
+
+
+budget = MemoryBudget(config.memory_budget_bytes, config.max_image_bytes, config.memory_sample_rate,
+                      config.speculative_images)
+metrics.MEMORY_RESERVED.set_function(budget.total_reserved)
@@ -0,0 +1,144 @@
+from collections import namedtuple
+
+import config
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.ext import ConversationHandler
+
+
+END = ConversationHandler.END
+BACK = "⬅️Back"
+DONE_TEXT = "✔️Done"
+PER_PAGE = 12
+# value of the button that closes a multi-select step
+DONE = -1
+REGENERATE = "slide"
+SLIDE_TITLE_LENGTH = 24
+
+PRESENTATION = "presentation"
+ABSTRACT = "abstract"
+
+LANGUAGES = ['English', 'Russian', 'German', 'French', 'Italian', 'Spanish', 'Ukrainian', 'Polish', 'Turkish',
+             'Romanian', 'Dutch', 'Greek', 'Czech', 'Portuguese', 'Swedish', 'Hungarian', 'Serbian', 'Bulgarian',
+             'Danish', 'Norwegian', 'Finnish', 'Slovak', 'Croatian', 'Arabic', 'Hebrew', 'Lithuanian', 'Slovenian',
+             'Bengali', 'Chinese', 'Persian', 'Indonesian', 'Latvian', 'Tamil', 'Japanese', 'Estonian', 'Telugu',
+             'Korean', 'Thai', 'Icelandic', 'Vietnamese']
+LANGUAGES_EMOJI = ['🇬🇧', '🏳️', '🇩🇪', '🇫🇷', '🇮🇹', '🇪🇸', '🇺🇦', '🇵🇱', '🇹🇷', '🇷🇴', '🇳🇱', '🇬🇷',
+                   '🇨🇿', '🇵🇹', '🇸🇪', '🇭🇺', '🇷🇸', '🇧🇬', '🇩🇰', '🇳🇴', '🇫🇮', '🇸🇰', '🇭🇷', '🇸🇦',
+                   '🇮🇱', '🇱🇹', '🇸🇮', '🇧🇩', '🇨🇳', '🇮🇷', '🇮🇩', '🇱🇻', '🇮🇳', '🇯🇵', '🇪🇪', '🇮🇳',
+                   '🇰🇷', '🇹🇭', '🇮🇸', '🇻🇳']
+TEMPLATES = ["Mountains", "Organic", "East Asia", "Explore", "3D Float", "Luminous", "Academic", "Snowflake", "Floral",
+             "Minimal"]
+TEMPLATES_EMOJI = ["🗻", "🌿", "🐼", "🧭", "🌑", "🕯️", "🎓", "❄️", "🌺", "◽"]
+TYPES = ["Fun", "Serious", "Creative", "Informative", "Inspirational", "Motivational", "Educational", "Historical",
+         "Romantic", "Mysterious", "Relaxing", "Adventurous", "Humorous", "Scientific", "Musical", "Horror", "Fantasy",
+         "Action", "Dramatic", "Satirical", "Poetic", "Thriller", "Sports", "Comedy", "Biographical", "Political",
+         "Magical", "Mystery", "Travel", "Documentary", "Crime", "Cooking"]
+TYPES_EMOJI = ["😂", "😐", "🎨", "📚", "🌟", "💪", "👨‍🎓", "🏛️", "💕", "🕵️‍♂️", "🧘‍♀️", "🗺️", "🤣", "🔬", "🎵", "😱", "🦄",
+               "💥", "😮", "🙃", "🌸", "😰", "⚽", "😆", "📜", "🗳️", "✨", "🔮", "✈️", "🎥", "🚓", "🍽️"]
+COUNTS = [str(i) for i in range(3, 27)]
+COUNTS_EMOJI = ["", "", "", "", "", "", "", "", "", "", "", "", "", "", "", "", "", "", "", "", "", "", "", ""]
+ABSTRACT_VARIANT = "Abstract"
+VARIANTS = TEMPLATES + [ABSTRACT_VARIANT]
+VARIANTS_EMOJI = TEMPLATES_EMOJI + ["📝"]
+
+Flow = namedtuple("Flow", ["name", "emoji", "topic_text", "steps"])
+Step = namedtuple("Step", ["name", "text", "options", "emoji", "multi"], defaults=[False])
+
+FLOWS = {
+    PRESENTATION: Flow("Presentation", "💻", "Whats topic of your Presentation?", [
+        Step("language", "Choose language of your Presentation:", LANGUAGES, LANGUAGES_EMOJI),
+        Step("template", "Choose template of your Presentation:", TEMPLATES, TEMPLATES_EMOJI),
+        Step("type", "Choose type of your Presentation:", TYPES, TYPES_EMOJI),
+        Step("count", "Choose an approximate number of slides for your Presentation:", COUNTS, COUNTS_EMOJI),
+    ] + ([
+        Step("variants", "Also get the same Presentation in other templates or as an Abstract, then press Done:",
+             VARIANTS, VARIANTS_EMOJI, multi=True),
+    ] if config.presentation_variants else [])),
+    ABSTRACT: Flow("Abstract", "📝", "Whats topic of your Abstract?", [
+        Step("language", "Choose language of your Abstract:", LANGUAGES, LANGUAGES_EMOJI),
+        Step("type", "Choose type of your Abstract:", TYPES, TYPES_EMOJI),
+    ]),
+}
+
+
+def callback_data(flow, step, value="", page=""):
+    return f"{flow}|{step}|{value}|{page}"
+
+
+def parse_callback_data(data):
+    """Split callback data of a menu button into (flow, step, value, page), value or page is None when unset."""
+    flow, step, value, page = data.split("|")
+    return flow, int(step), int(value) if value else None, int(page) if page else None
+
+
+def is_flow_callback(flow):
+    prefix = f"{flow}|"
+    return lambda data: isinstance(data, str) and data.startswith(prefix)
+
+
+def build_step_keyboard(flow, step_index, step, page, selected=()):
+    keyboard = []
+    first = (page - 1) * PER_PAGE
+    for i, option in enumerate(step.options[first:first + PER_PAGE], first):
+        text = ("✅" if option in selected else step.emoji[i]) + option
+        button = InlineKeyboardButton(text, callback_data=callback_data(flow, step_index, i))
+        if (i - first) % 2 == 0:
+            keyboard.append([button])
+        else:
+            keyboard[-1].append(button)
+    paging = []
+    if page > 1:
+        paging.append(InlineKeyboardButton("<<", callback_data=callback_data(flow, step_index, page=page - 1)))
+    if len(step.options) > page * PER_PAGE:
+        paging.append(InlineKeyboardButton(">>", callback_data=callback_data(flow, step_index, page=page + 1)))
+    if paging:
+        keyboard.append(paging)
+    if step.multi:
+        keyboard.append([InlineKeyboardButton(DONE_TEXT, callback_data=callback_data(flow, step_index, DONE))])
+    keyboard.append([InlineKeyboardButton(text=BACK, callback_data=str(END))])
+    return InlineKeyboardMarkup(keyboard)
+
+
+def regenerate_data(deck_id, slide=""):
+    return f"{REGENERATE}|{deck_id}|{slide}"
+
+
+def parse_regenerate_data(data):
+    """Split callback data of a regenerate button into (deck_id, slide), slide is None for the list of slides."""
+    _, deck_id, slide = data.split("|")
+    return deck_id, int(slide) if slide else None
+
+
+def build_regenerate_keyboard(deck_id):
+    return InlineKeyboardMarkup([[InlineKeyboardButton("🔁Regenerate a slide", callback_data=regenerate_data(deck_id))]])
+
+
+def build_slides_keyboard(deck_id, titles):
+    keyboard = []
+    for i, title in enumerate(titles):
+        text = f"{i + 1}. {title[:SLIDE_TITLE_LENGTH]}"
+        button = InlineKeyboardButton(text, callback_data=regenerate_data(deck_id, i))
+        if i % 2 == 0:
+            keyboard.append([button])
+        else:
+            keyboard[-1].append(button)
+    keyboard.append([InlineKeyboardButton(text=BACK, callback_data=regenerate_data(deck_id, END))])
+    return InlineKeyboardMarkup(keyboard)
+
+
+def build_keyboards():
+    keyboards = {}
+    for flow, flow_def in FLOWS.items():
+        for step_index, step in enumerate(flow_def.steps):
+            n_pages = (len(step.options) + PER_PAGE - 1) // PER_PAGE
+            for page in range(1, n_pages + 1):
+                keyboards[(flow, step_index, page)] = build_step_keyboard(flow, step_index, step, page)
+    return keyboards
+
+
+MENU_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton(f"{flow_def.emoji}{flow_def.name}", callback_data=callback_data(flow, 0, page=1))]
+    for flow, flow_def in FLOWS.items()
+])
+KEYBOARDS = build_keyboards()
@@ -0,0 +1,168 @@
+import bisect
+import contextlib
+import logging
+import math
+import time
+
+from aiohttp import web
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for _, value in labels)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped)) + "}"
+
+
+def format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value))
+
+
+class Metric:
+    type = ""
+
+    def __init__(self, name, documentation):
+        self.name = name
+        self.documentation = documentation
+        REGISTRY.append(self)
+
+    def samples(self):
+        return []
+
+    def expose(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        for name, labels, value in self.samples():
+            lines.append(f"{name}{format_labels(labels)} {format_value(value)}")
+        return lines
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, name, documentation):
+        super().__init__(name, documentation)
+        self.values = {}
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        return [(self.name, labels, value) for labels, value in self.values.items()]
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def __init__(self, name, documentation):
+        super().__init__(name, documentation)
+        self.value = 0
+        self.function = None
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def set_function(self, function):
+        self.function = function
+
+    def samples(self):
+        value = self.function() if self.function is not None else self.value
+        return [(self.name, (), value)]
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name, documentation, buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation)
+        self.buckets = tuple(buckets) + (math.inf,)
+        self.series = {}
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        if key not in self.series:
+            self.series[key] = {"buckets": [0] * len(self.buckets), "sum": 0, "count": 0}
+        series = self.series[key]
+        series["buckets"][bisect.bisect_left(self.buckets, value)] += 1
+        series["sum"] += value
+        series["count"] += 1
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def samples(self):
+        samples = []
+        for labels, series in self.series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, series["buckets"]):
+                cumulative += count
+                samples.append((f"{self.name}_bucket", labels + (("le", format_value(bound)),), cumulative))
+            samples.append((f"{self.name}_sum", labels, series["sum"]))
+            samples.append((f"{self.name}_count", labels, series["count"]))
+        return samples
+
+
+REGISTRY = []
+
+STAGE_SECONDS = Histogram("generation_stage_seconds", "Duration of a generation pipeline stage")
+TOKENS = Counter("openai_tokens_total", "OpenAI tokens used by completions")
+IMAGE_RESULTS = Counter("images_total", "Images requested for slides and abstracts by result")
+IMAGE_DOWNLOAD_FAILURES = Counter("image_download_failures_total", "Image links that could not be downloaded")
+ERRORS = Counter("errors_total", "Errors by exception type")
+JOBS_IN_FLIGHT = Gauge("generation_jobs_in_flight", "Generation jobs being processed")
+QUEUE_DEPTH = Gauge("generation_queue_depth", "Generation jobs waiting for a worker")
+MEMORY_RESERVED = Gauge("memory_reserved_bytes", "Estimated peak memory of the generation jobs admitted to run")
+PROMPT_TOKENS = Counter("prompt_variant_tokens_total", "OpenAI tokens used by completions of a prompt variant")
+PROMPT_SECONDS = Histogram("prompt_variant_seconds", "Duration of completions of a prompt variant")
+PROMPT_PARSES = Counter("prompt_variant_parses_total", "Completions of a prompt variant by whether their reply parsed")
+BACKEND_REQUESTS = Counter("completion_backend_requests_total", "Completion requests by backend and result")
+BACKEND_SECONDS = Histogram("completion_backend_seconds", "Duration of completion requests by backend")
+HEDGED_COMPLETIONS = Counter("hedged_completions_total", "Completions hedged on a second backend by which request won")
+MARKUP_REPAIRS = Counter("markup_repairs_total", "Repairs made to the markup of completions by kind of repair")
+MARKUP_SCORE = Histogram("markup_score", "Markup score of completions by kind, 1 when they needed no repair",
+                         buckets=(0, 0.25, 0.5, 0.75, 0.9, 0.95, 1))
+MARKUP_CONTINUATIONS = Counter("markup_continuations_total", "Completions requested to fill in what a completion missed")
+RATE_LIMITED = Counter("rate_limited_updates_total", "Updates dropped by the per-user rate limit by action class")
+READY = Gauge("ready", "1 once warm-up has finished and the process serves users")
+
+
+def render():
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.expose())
+    return "\n".join(lines) + "\n"
+
+
+async def start_server(host, port):
+    async def metrics_handle(request: web.Request) -> web.Response:
+        return web.Response(body=render().encode(), headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+    async def ready_handle(request: web.Request) -> web.Response:
+        return web.Response(status=200 if READY.value else 503, text="ready" if READY.value else "warming up")
+
+    web_app = web.Application()
+    web_app.router.add_get("/metrics", metrics_handle)
+    web_app.router.add_get("/ready", ready_handle)
+    runner = web.AppRunner(web_app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info(f"Serving metrics on {host}:{port}")
+    return runner
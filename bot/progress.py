@@ -0,0 +1,83 @@
+import asyncio
+import contextlib
+import contextvars
+import logging
+
+import telegram
+
+
+logger = logging.getLogger(__name__)
+
+current_reporter = contextvars.ContextVar("current_reporter", default=None)
+
+# when each chat's status message was last edited, shared by the jobs of a chat
+last_edit_at = {}
+
+
+class ProgressReporter:
+    """Edits a job's status message, coalescing updates to one edit per min_interval seconds per chat."""
+
+    def __init__(self, bot, chat_id, message_id, min_interval):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.min_interval = min_interval
+        self.text = None
+        self.sent_text = None
+        self.flush_task = None
+        self.closed = False
+
+    def report(self, text):
+        if self.closed:
+            return
+        self.text = text
+        if self.flush_task is None:
+            self.flush_task = asyncio.create_task(self.flush())
+
+    async def flush(self):
+        loop = asyncio.get_running_loop()
+        delay = last_edit_at.get(self.chat_id, -self.min_interval) + self.min_interval - loop.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        self.flush_task = None
+        if self.text == self.sent_text:
+            return
+        last_edit_at[self.chat_id] = loop.time()
+        self.sent_text = self.text
+        try:
+            await self.bot.edit_message_text(self.text, chat_id=self.chat_id, message_id=self.message_id)
+        except telegram.error.TelegramError as e:
+            logger.debug(f"Could not update progress of chat {self.chat_id}: {e}")
+
+    def close(self):
+        self.closed = True
+        if self.flush_task is not None:
+            self.flush_task.cancel()
+            self.flush_task = None
+        if asyncio.get_running_loop().time() - last_edit_at.get(self.chat_id, 0) >= self.min_interval:
+            last_edit_at.pop(self.chat_id, None)
+
+
+def report(text):
+    """Show text in the status message of the current job, does nothing outside of a job."""
+    reporter = current_reporter.get()
+    if reporter is not None:
+        reporter.report(text)
+
+
+def stop():
+    """Stop editing the status message of the current job, e.g. because it is about to be deleted."""
+    reporter = current_reporter.get()
+    if reporter is not None:
+        reporter.close()
+
+
+@contextlib.contextmanager
+def reporting(bot, chat_id, message_id, min_interval):
+    reporter = ProgressReporter(bot, chat_id, message_id, min_interval)
+    token = current_reporter.set(reporter)
+    try:
+        yield reporter
+    finally:
+        reporter.close()
+        current_reporter.reset(token)
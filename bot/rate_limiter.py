@@ -0,0 +1,214 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+
+import telegram
+from telegram.ext import BaseRateLimiter
+
+
+logger = logging.getLogger(__name__)
+
+HIGH_PRIORITY = 0
+NORMAL_PRIORITY = 1
+LOW_PRIORITY = 2
+
+# endpoints that deliver what the user is waiting for go ahead of everything else
+HIGH_PRIORITY_ENDPOINTS = {"sendDocument", "sendMediaGroup", "answerCallbackQuery", "answerPreCheckoutQuery"}
+MAX_CHAT_BUCKETS = 10000
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = asyncio.get_running_loop().time()
+
+    def refill(self):
+        now = asyncio.get_running_loop().time()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def reserve(self):
+        """Take a token, possibly one that is yet to be refilled, and return how long to wait for it."""
+        self.refill()
+        self.tokens -= 1
+        return max(0.0, -self.tokens / self.rate)
+
+    def time_until_token(self):
+        self.refill()
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+    @property
+    def full(self):
+        self.refill()
+        return self.tokens >= self.capacity
+
+
+class OutboundRateLimiter(BaseRateLimiter[int]):
+    """Keeps outgoing requests under Telegram's global and per-chat limits.
+
+    Requests first wait for their chat's bucket, then for the global bucket, which is handed out
+    by priority: documents first, error dumps last. RetryAfter pauses all requests and the failed
+    request is retried up to max_retries times.
+    """
+
+    def __init__(self, global_rate=30, chat_rate=1, chat_burst=3, max_retries=3):
+        self.global_rate = global_rate
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+
+        self._global_bucket = None
+        self._chat_buckets = {}
+        self._waiters = []
+        self._counter = itertools.count()
+        self._wakeup = None
+        self._dispatcher = None
+        self._paused_until = 0
+
+    async def initialize(self) -> None:
+        # the application and its updater both initialize the bot
+        if self._dispatcher is not None:
+            return
+        self._global_bucket = TokenBucket(self.global_rate, self.global_rate)
+        self._wakeup = asyncio.Event()
+        self._dispatcher = asyncio.create_task(self._dispatch())
+
+    async def shutdown(self) -> None:
+        if self._dispatcher is not None:
+            self._dispatcher.cancel()
+            await asyncio.gather(self._dispatcher, return_exceptions=True)
+            self._dispatcher = None
+
+    async def _dispatch(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            if not self._waiters:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            delay = max(self._paused_until - loop.time(), self._global_bucket.time_until_token())
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                self._global_bucket.reserve()
+                future.set_result(None)
+
+    async def _acquire_global(self, priority):
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._counter), future))
+        self._wakeup.set()
+        await future
+
+    async def _acquire_chat(self, chat_id):
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self._chat_buckets) >= MAX_CHAT_BUCKETS:
+                self._chat_buckets = {key: value for key, value in self._chat_buckets.items() if not value.full}
+            bucket = self._chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        delay = bucket.reserve()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        if rate_limit_args is not None:
+            priority = rate_limit_args
+        elif endpoint in HIGH_PRIORITY_ENDPOINTS:
+            priority = HIGH_PRIORITY
+        else:
+            priority = NORMAL_PRIORITY
+
+        chat_id = data.get("chat_id")
+        for attempt in range(self.max_retries + 1):
+            if chat_id is not None:
+                await self._acquire_chat(chat_id)
+            await self._acquire_global(priority)
+            try:
+                return await callback(*args, **kwargs)
+            except telegram.error.RetryAfter as e:
+                if attempt == self.max_retries:
+                    raise
+                logger.warning(f"Flood control on {endpoint}, retrying in {e.retry_after} s")
+                loop = asyncio.get_running_loop()
+                self._paused_until = max(self._paused_until, loop.time() + e.retry_after)
+                await asyncio.sleep(e.retry_after)
+
+
+# action classes of incoming updates that are rate limited per user
+CALLBACK = "callback"
+TOPIC = "topic"
+PAYMENT = "payment"
+MAX_TRACKED_WINDOWS = 100000
+MIN_RETRY_AFTER = 1
+
+
+class InboundRateLimiter:
+    """Limits how many updates of each action class a user may send within a sliding window.
+
+    The sliding window is approximated by two fixed ones: the attempts of the current window plus those of
+    the previous one, weighted by how much of it the sliding window still covers. Rejected attempts count
+    too, so a user who keeps trying stays limited. Given a db, the counts are kept in MongoDB and shared by
+    every bot instance, with the local counts as a fallback while it is unreachable.
+    """
+
+    def __init__(self, limits, db=None):
+        self.limits = limits
+        self.db = db
+
+        self._windows = {}
+        self._notified = {}
+
+    def _count_locally(self, key, window_start, window):
+        counts = self._windows.get(key)
+        if counts is None or counts[0] < window_start - window:
+            counts = [window_start, 0, 0]
+        elif counts[0] < window_start:
+            counts = [window_start, 0, counts[1]]
+        counts[1] += 1
+        self._windows[key] = counts
+        if len(self._windows) > MAX_TRACKED_WINDOWS:
+            self._windows = {key: value for key, value in self._windows.items()
+                             if value[0] >= window_start - self.limits[key[1]]["window"]}
+            self._notified = {key: value for key, value in self._notified.items() if key in self._windows}
+        return counts[1], counts[2]
+
+    async def _count(self, key, window_start, window):
+        if self.db is not None:
+            try:
+                return await asyncio.to_thread(self.db.count_rate_limit_hit, f"{key[0]}:{key[1]}", window_start,
+                                               window)
+            except Exception as e:
+                logger.warning(f"Failed to count a rate limited update in MongoDB, counting locally: {e}")
+        return self._count_locally(key, window_start, window)
+
+    async def hit(self, user_id, action):
+        """Count an attempt of the user and return the seconds until the next one may go ahead, 0 for this one."""
+        if action not in self.limits:
+            return 0
+        limit, window = self.limits[action]["limit"], self.limits[action]["window"]
+        now = time.time()
+        window_start = int(now // window * window)
+        elapsed = now - window_start
+        current, previous = await self._count((user_id, action), window_start, window)
+        if previous * (1 - elapsed / window) + current <= limit:
+            return 0
+        if current < limit:
+            # the previous window's attempts fade out until there is room again
+            retry_after = window * (1 - (limit - current) / previous) - elapsed
+        else:
+            retry_after = window - elapsed + window * (1 - limit / current)
+        return max(MIN_RETRY_AFTER, retry_after)
+
+    def should_notify(self, user_id, action):
+        """Whether a rejected attempt is the first of its window, so a burst gets a single cooldown message."""
+        window = self.limits[action]["window"]
+        window_start = int(time.time() // window * window)
+        if self._notified.get((user_id, action)) == window_start:
+            return False
+        self._notified[(user_id, action)] = window_start
+        return True
@@ -0,0 +1,141 @@
+import contextlib
+import contextvars
+import cProfile
+import json
+import logging
+import time
+import uuid
+from datetime import datetime
+from pathlib import Path
+
+
+logger = logging.getLogger(__name__)
+
+current_span = contextvars.ContextVar("current_span", default=None)
+
+
+class Span:
+    def __init__(self, name, trace_id, parent_id, attributes):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent_id
+        self.attributes = attributes
+        self.started_at = datetime.now()
+        self.start = time.perf_counter()
+        self.duration = None
+        self.error = None
+        self.children = []
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "started_at": self.started_at.isoformat(),
+            "duration_s": self.duration,
+            "error": self.error,
+            "attributes": self.attributes,
+        }
+
+    def flatten(self):
+        spans = [self.to_dict()]
+        for child in self.children:
+            spans.extend(child.flatten())
+        return spans
+
+
+@contextlib.contextmanager
+def span(name, **attributes):
+    """Record a span nested in the current one, does nothing outside of a trace."""
+    parent = current_span.get()
+    if parent is None:
+        yield None
+        return
+
+    child = Span(name, parent.trace_id, parent.span_id, attributes)
+    parent.children.append(child)
+    token = current_span.set(child)
+    try:
+        yield child
+    except BaseException as e:
+        child.error = type(e).__name__
+        raise
+    finally:
+        child.duration = time.perf_counter() - child.start
+        current_span.reset(token)
+
+
+@contextlib.contextmanager
+def trace(trace_id, sink_path, **attributes):
+    root = Span("job", trace_id, None, attributes)
+    token = current_span.set(root)
+    try:
+        yield root
+    except BaseException as e:
+        root.error = type(e).__name__
+        raise
+    finally:
+        root.duration = time.perf_counter() - root.start
+        current_span.reset(token)
+        if sink_path:
+            write_trace(root, sink_path)
+
+
+def write_trace(root, sink_path):
+    record = {"trace_id": root.trace_id, "duration_s": root.duration, "spans": root.flatten()}
+    try:
+        with open(sink_path, "a") as f:
+            f.write(json.dumps(record, ensure_ascii=False, default=str) + "\n")
+    except OSError:
+        logger.exception(f"Could not write trace {root.trace_id} to {sink_path}")
+
+
+class Profiler:
+    """Profiles the next N submitted jobs with cProfile.
+
+    Jobs are marked for profiling when they are submitted, so whichever process runs them, the bot or a
+    worker, profiles them. cProfile hooks the whole thread, so a profile also holds whatever other jobs ran
+    on the event loop meanwhile, and a process profiles one job at a time.
+    """
+
+    def __init__(self):
+        self.remaining = 0
+        self.active = False
+
+    def arm(self, n_jobs):
+        self.remaining = n_jobs
+
+    def claim(self):
+        """Whether to mark the job being submitted for profiling."""
+        if self.remaining <= 0:
+            return False
+        self.remaining -= 1
+        return True
+
+    @contextlib.contextmanager
+    def profile(self, job, profile_dir):
+        job_id = job["id"]
+        if not job.get("profile"):
+            yield
+            return
+        if self.active:
+            logger.warning(f"Not profiling job {job_id}, another job is being profiled")
+            yield
+            return
+
+        self.active = True
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            self.active = False
+            path = Path(profile_dir) / f"{job_id}.prof"
+            path.parent.mkdir(parents=True, exist_ok=True)
+            profiler.dump_stats(path)
+            logger.info(f"Saved profile of job {job_id} to {path}")
+
+
+profiler = Profiler()
@@ -0,0 +1,174 @@
+import asyncio
+import collections
+import contextlib
+import contextvars
+import logging
+import time
+import uuid
+from datetime import datetime, timedelta
+
+import config
+
+
+logger = logging.getLogger(__name__)
+
+current_event = contextvars.ContextVar("current_event", default=None)
+
+# scope of the rollups summed over all users
+ALL_USERS = "all"
+# events kept while Mongo is unreachable, in batches
+MAX_BUFFERED_BATCHES = 10
+
+
+def period_starts(created_at):
+    return {
+        "hour": created_at.replace(minute=0, second=0, microsecond=0),
+        "day": created_at.replace(hour=0, minute=0, second=0, microsecond=0),
+    }
+
+
+def rollup_id(scope, period, start):
+    return f"{scope}:{period}:{start:%Y-%m-%dT%H}"
+
+
+def field_name(name):
+    # template names end up in field names, which may not contain dots or start with $
+    return str(name).replace(".", "_").lstrip("$")
+
+
+def build_rollups(events):
+    """Sum events into $inc documents of the hourly and daily rollups of their users and of all users."""
+    rollups = {}
+    for event in events:
+        increments = collections.Counter({
+            "jobs": 1,
+            f"status.{event['status']}": 1,
+            f"kinds.{event['kind']}": 1,
+            "tokens": event["tokens"],
+            "documents": event["documents"],
+            "cache_hits": event["cache_hits"],
+            "latency_s": event["latency_s"],
+            "slides": event["slides"] or 0,
+        })
+        if event["template"]:
+            increments[f"templates.{field_name(event['template'])}"] += 1
+        for scope in (event["user_id"], ALL_USERS):
+            for period, start in period_starts(event["created_at"]).items():
+                rollup = rollups.setdefault(rollup_id(scope, period, start), {
+                    "scope": scope, "period": period, "start": start, "increments": collections.Counter(),
+                })
+                rollup["increments"].update(increments)
+    return rollups
+
+
+class UsageRecorder:
+    """Buffers a usage event per generation job and writes them with their rollups in batches."""
+
+    def __init__(self, batch_size, flush_interval):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+
+        self.db = None
+        self.events = []
+        # (batch id, events) of batches waiting to be written, a failed batch is retried under the same id
+        self.batches = collections.deque(maxlen=MAX_BUFFERED_BATCHES)
+        self._flush_lock = asyncio.Lock()
+        self._flusher = None
+        self._flush_task = None
+
+    def start(self, db):
+        self.db = db
+        self._flusher = asyncio.create_task(self._flush_periodically())
+
+    async def close(self):
+        if self._flusher is not None:
+            self._flusher.cancel()
+            await asyncio.gather(self._flusher, return_exceptions=True)
+            self._flusher = None
+        if self._flush_task is not None:
+            await asyncio.gather(self._flush_task, return_exceptions=True)
+            self._flush_task = None
+        await self.flush()
+
+    def record(self, event):
+        self.events.append(event)
+        del self.events[:-MAX_BUFFERED_BATCHES * self.batch_size]
+        if len(self.events) >= self.batch_size and self._flusher is not None and \
+                (self._flush_task is None or self._flush_task.done()):
+            self._flush_task = asyncio.create_task(self.flush())
+
+    async def _flush_periodically(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    async def flush(self):
+        async with self._flush_lock:
+            if self.db is None:
+                return
+            if self.events:
+                self.batches.append((uuid.uuid4().hex, self.events))
+                self.events = []
+            while self.batches:
+                batch_id, events = self.batches[0]
+                try:
+                    await asyncio.to_thread(self.db.write_usage, batch_id, events, build_rollups(events))
+                except Exception:
+                    logger.exception(f"Failed to write {len(events)} usage events")
+                    return
+                self.batches.popleft()
+
+
+def add(name, amount=1):
+    """Add to a counter of the current job's usage event, does nothing outside of a job."""
+    event = current_event.get()
+    if event is not None:
+        event[name] += amount
+
+
+def set_status(status):
+    event = current_event.get()
+    if event is not None:
+        event["status"] = status
+
+
+@contextlib.contextmanager
+def recording(job):
+    event = {
+        "user_id": job["user_id"],
+        "job_id": job["id"],
+        "kind": job["kind"],
+        "template": job.get("template"),
+        "variants": len(job.get("variants", [])),
+        "slides": job.get("count"),
+        "prompt_variant": job.get("prompt_variant"),
+        "tokens": 0,
+        "documents": 0,
+        "cache_hits": 0,
+        "status": "done",
+        "created_at": datetime.now(),
+    }
+    token = current_event.set(event)
+    started = time.perf_counter()
+    try:
+        yield event
+    except asyncio.CancelledError:
+        event["status"] = "checkpointed" if job.get("checkpointed") else "cancelled"
+        raise
+    except Exception:
+        event["status"] = "failed"
+        raise
+    finally:
+        event["latency_s"] = time.perf_counter() - started
+        current_event.reset(token)
+        recorder.record(event)
+
+
+def daily_history(db, scope, n_days):
+    """Daily rollups of the last n_days, newest first, read by their ids."""
+    today = period_starts(datetime.now())["day"]
+    ids = [rollup_id(scope, "day", today - timedelta(days=i)) for i in range(n_days)]
+    return sorted(db.get_usage_rollups(ids), key=lambda rollup: rollup["start"], reverse=True)
+
+
+recorder = UsageRecorder(config.usage_batch_size, config.usage_flush_interval)
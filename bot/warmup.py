@@ -0,0 +1,71 @@
+import asyncio
+import importlib
+import logging
+import time
+
+import config
+
+import http_pool
+
+import metrics
+
+
+logger = logging.getLogger(__name__)
+
+ready = False
+phase_seconds = {}
+
+
+# imported on first use by the pipeline, so importing bot.py stays cheap
+GENERATOR_MODULES = ["docx", "pptx", "openai", "ai_generator.abstract", "ai_generator.presentation",
+                     "ai_generator.openai_utils"]
+
+
+def import_generators():
+    for name in GENERATOR_MODULES:
+        importlib.import_module(name)
+
+
+async def preload_templates():
+    import ai_generator.presentation as presentation
+    await asyncio.to_thread(presentation.preload_templates)
+
+
+async def open_http_pool():
+    http_pool.get_session()
+
+
+async def load_tokenizers():
+    # tiktoken downloads an encoding the first time it is used
+    import ai_generator.openai_utils as openai_utils
+    for backend in config.completion_backends:
+        await asyncio.to_thread(openai_utils.get_encoding, backend["model"])
+
+
+async def run_phase(name, phase):
+    started = time.perf_counter()
+    result = phase()
+    if asyncio.iscoroutine(result):
+        await result
+    phase_seconds[name] = time.perf_counter() - started
+    metrics.STAGE_SECONDS.observe(phase_seconds[name], stage=f"warmup_{name}")
+    logger.info(f"Warm-up phase {name} took {phase_seconds[name]:.3f} s")
+
+
+async def warm_up(db):
+    """Run the warm-up phases, the process is ready to serve users once they are done."""
+    global ready
+    started = time.perf_counter()
+    await run_phase("imports", import_generators)
+    await run_phase("database", lambda: asyncio.to_thread(db.ping))
+    await run_phase("templates", preload_templates)
+    await run_phase("http_pool", open_http_pool)
+    if config.stream_completions:
+        await run_phase("tokenizers", load_tokenizers)
+    ready = True
+    metrics.READY.set(1)
+    logger.info(f"Ready after {time.perf_counter() - started:.3f} s of warm-up")
+
+
+def status():
+    return {"ready": ready, "warmup_phase_seconds": phase_seconds}
@@ -0,0 +1,90 @@
+import asyncio
+import hmac
+import logging
+import secrets
+import signal
+from urllib.parse import urlparse
+
+from aiohttp import web
+
+import config
+
+from telegram import Update
+from telegram.ext import Application
+
+import warmup
+
+
+logger = logging.getLogger(__name__)
+
+
+def build_web_app(application: Application, secret_token: str) -> web.Application:
+    if not secret_token:
+        raise ValueError("The webhook listener needs a secret token, or anyone can post forged updates to it")
+
+    async def update_handle(request: web.Request) -> web.Response:
+        request_token = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+        if not hmac.compare_digest(request_token, secret_token):
+            return web.Response(status=403)
+        if not warmup.ready:
+            # Telegram redelivers the update later
+            return web.Response(status=503)
+        try:
+            update = Update.de_json(await request.json(), application.bot)
+        except ValueError:
+            return web.Response(status=400)
+        await application.update_queue.put(update)
+        return web.Response()
+
+    async def health_handle(request: web.Request) -> web.Response:
+        return web.json_response({
+            "status": "ok" if application.running else "stopped",
+            "pending_updates": application.update_queue.qsize(),
+            **warmup.status(),
+        })
+
+    async def ready_handle(request: web.Request) -> web.Response:
+        return web.json_response(warmup.status(), status=200 if warmup.ready else 503)
+
+    web_app = web.Application()
+    web_app.router.add_post(urlparse(config.webhook_url).path or "/", update_handle)
+    web_app.router.add_get("/health", health_handle)
+    web_app.router.add_get("/ready", ready_handle)
+    return web_app
+
+
+async def run_webhook(application: Application) -> None:
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+
+    secret_token = config.webhook_secret_token
+    if not secret_token:
+        # only this process knows it, so bot instances sharing a webhook need webhook_secret_token set
+        secret_token = secrets.token_urlsafe(32)
+        logger.warning("webhook_secret_token is not set, registering the webhook with a random one")
+    runner = web.AppRunner(build_web_app(application, secret_token))
+    async with application:
+        # listen before warming up so that /health answers and /ready reports the warm-up
+        await runner.setup()
+        await web.TCPSite(runner, config.webhook_listen, config.webhook_port).start()
+        logger.info(f"Listening for webhook updates on {config.webhook_listen}:{config.webhook_port}")
+        if application.post_init:
+            await application.post_init(application)
+        await application.start()
+        await application.bot.set_webhook(
+            url=config.webhook_url,
+            secret_token=secret_token,
+            max_connections=config.webhook_max_connections,
+            allowed_updates=Update.ALL_TYPES,
+        )
+        try:
+            await stop_event.wait()
+        finally:
+            await runner.cleanup()
+            await application.stop()
+            if application.post_stop:
+                await application.post_stop(application)
+            if application.post_shutdown:
+                await application.post_shutdown(application)
@@ -0,0 +1,101 @@
+import asyncio
+import logging
+import signal
+import socket
+import uuid
+
+import config
+
+import database
+
+import generation
+
+import http_pool
+
+import metrics
+
+import rate_limiter
+
+import telegram
+from telegram.ext import ExtBot
+
+import usage
+
+import warmup
+
+
+db = database.Database()
+logger = logging.getLogger(__name__)
+
+POLL_INTERVAL = 1
+
+stopping = asyncio.Event()
+
+
+async def run_claimed_job(bot: telegram.Bot, worker_id: str, job: dict) -> None:
+    task = asyncio.create_task(generation.run_job(bot, db, job))
+    try:
+        while not task.done():
+            await asyncio.wait({task}, timeout=config.job_lease_seconds / 3)
+            if not task.done() and not db.renew_job_lease(job["_id"], worker_id, config.job_lease_seconds):
+                # the job was cancelled by its user or the lease went to another worker
+                logger.info(f"Lost lease of job {job['_id']}")
+                task.cancel()
+        await task
+    except asyncio.CancelledError:
+        if asyncio.current_task().cancelling():
+            # the drain deadline has passed, hand the job and its finished stages back for another worker
+            job["checkpointed"] = True
+            task.cancel()
+            await asyncio.wait({task})
+            db.requeue_job(job["_id"], worker_id, job.get("checkpoint", {}))
+            raise
+    except Exception:
+        logger.exception(f"Job {job['_id']} failed")
+        db.set_job_status(job["_id"], worker_id, "failed")
+    else:
+        db.set_job_status(job["_id"], worker_id, "done")
+
+
+async def work(bot: telegram.Bot, worker_id: str) -> None:
+    while not stopping.is_set():
+        job = db.claim_job(worker_id, config.job_lease_seconds, config.job_max_attempts)
+        if job is None:
+            db.fail_abandoned_jobs(config.job_max_attempts)
+            await asyncio.sleep(POLL_INTERVAL)
+            continue
+        logger.info(f"Worker {worker_id} claimed job {job['_id']} (attempt {job['attempts']})")
+        await run_claimed_job(bot, worker_id, job)
+
+
+def drain(main_task: asyncio.Task) -> None:
+    # stop claiming jobs and give the running ones drain_timeout seconds before checkpointing them
+    logger.info(f"Draining, running jobs have {config.drain_timeout} s to finish")
+    stopping.set()
+    asyncio.get_running_loop().call_later(config.drain_timeout, main_task.cancel)
+
+
+async def run_worker() -> None:
+    main_task = asyncio.current_task()
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, drain, main_task)
+
+    db.ensure_job_indexes()
+    db.ensure_deck_indexes()
+    if config.metrics_port:
+        await metrics.start_server(config.metrics_host, config.metrics_port)
+    await warmup.warm_up(db)
+    usage.recorder.start(db)
+    worker_name = f"{socket.gethostname()}-{uuid.uuid4().hex[:8]}"
+    limiter = rate_limiter.OutboundRateLimiter(config.outbound_global_rate, config.outbound_chat_rate,
+                                               config.outbound_chat_burst)
+    async with ExtBot(config.telegram_token, base_url=config.telegram_api_url, rate_limiter=limiter) as bot:
+        try:
+            await asyncio.gather(*(work(bot, f"{worker_name}-{i}") for i in range(config.generation_workers)))
+        finally:
+            await usage.recorder.close()
+            await http_pool.close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(run_worker())